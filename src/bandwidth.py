@@ -0,0 +1,157 @@
+import re
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+
+RATE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+SATURATED = 0.9  # a download using this much of its share is taken to want more
+HEADROOM = 1.25  # a download below its share may still grow this far past its rate before the next report
+
+
+def parseRate(text):
+	# "500K", "2M" or plain bytes per second
+	match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?(?:/s)?\s*', str(text).lower())
+
+	if not match:
+		raise ValueError(f"Bad rate: {text}")
+
+	return int(float(match.group(1)) * RATE_UNITS[match.group(2)])
+
+
+def formatRate(rate):
+	return f"{rate / 1024 ** 2:.2f} MiB/s"
+
+
+@dataclass(slots=True)
+class Flow:
+	downloaded: int = 0
+	total: int = None
+	rate: float = 0.0  # smoothed bytes per second
+	hungry: bool = True  # held back by or using up its share on the last report, so it would take more
+	share: float = float("inf")
+	ready_at: float = 0.0
+	updated: float = 0.0
+
+
+class BandwidthController:
+
+	def __init__(self, rate=None, task_rate=None, report_every=10, report=print):
+		self.rate = rate  # bytes per second for every download together, None is unlimited
+		self.task_rate = task_rate  # ceiling for a single download
+		self.report_every = report_every
+		self.report = report
+		self.lock = Lock()
+		self.flows = {}
+		self.total_bytes = 0
+		self.window = []  # (time, bytes) of recent reports, for the live aggregate rate
+		self.last_report = time.monotonic()
+
+	def shares(self):
+		# Max-min fair: downloads using less than an equal split keep what they use,
+		# the budget they leave is split among the ones that would take more
+		budget = self.rate if self.rate else float("inf")
+		cap = self.task_rate or float("inf")
+
+		def demand(flow):
+			return float("inf") if flow.hungry else flow.rate
+
+		ordered = sorted(self.flows.items(), key=lambda item: demand(item[1]))
+		shares = {}
+
+		for index, (task_id, flow) in enumerate(ordered):
+			shares[task_id] = min(budget / (len(ordered) - index), cap, demand(flow))
+			budget -= shares[task_id]
+
+			if not flow.hungry:
+				# Only the measured rate is taken from the budget; the headroom lets a download
+				# that speeds up claim budget back without holding it from the others meanwhile
+				shares[task_id] = min(shares[task_id] * HEADROOM, cap)
+
+		return shares
+
+	def consume(self, task_id, downloaded, total=None):
+		now = time.monotonic()
+
+		with self.lock:
+			flow = self.flows.get(task_id)
+
+			if flow is None:
+				return
+
+			# A restarted or new file reports from zero again
+			delta = downloaded - flow.downloaded if downloaded >= flow.downloaded else downloaded
+			flow.downloaded = downloaded
+			flow.total = total or flow.total
+			self.total_bytes += delta
+			self.window.append((now, delta))
+
+			if now > flow.updated:
+				flow.rate = 0.7 * flow.rate + 0.3 * delta / (now - flow.updated)
+
+			share = self.shares().get(task_id, float("inf"))
+			delay = 0.0
+
+			if share != float("inf") and share > 0:
+				# These bytes arrived since the last report, at the share they may not finish before ready_at
+				flow.ready_at = max(flow.ready_at, flow.updated) + delta / share
+				delay = flow.ready_at - now
+
+			flow.updated = now
+			# Only a download clearly below its share leaves budget for the others; one that merely
+			# kept up with its share is still backlogged and must not be capped at its own rate
+			flow.hungry = delay > 0 or flow.rate >= SATURATED * share
+			flow.share = share
+			report = now - self.last_report >= self.report_every
+
+			if report:
+				self.last_report = now
+
+		if report and self.report:
+			self.report(self.describe())
+
+		# Sleeping inside the progress hook holds back yt-dlp's read loop for this download only
+		if delay > 0:
+			time.sleep(delay)
+
+	def status(self):
+		now = time.monotonic()
+
+		with self.lock:
+			# Aggregate throughput over the last ten seconds
+			self.window = [(at, size) for at, size in self.window if now - at <= 10]
+			span = now - self.window[0][0] if len(self.window) > 1 else 0
+			rate = sum(size for _, size in self.window) / span if span > 0 else 0.0
+			remaining = sum(max(0, flow.total - flow.downloaded) for flow in self.flows.values() if flow.total)
+
+			return {
+				'active': len(self.flows),
+				'bytes_per_second': round(rate),
+				'downloaded_bytes': self.total_bytes,
+				'remaining_bytes': remaining,
+				'eta': round(remaining / rate, 1) if rate > 0 else None,
+			}
+
+	def describe(self):
+		status = self.status()
+		eta = f"{status['eta']:.0f}s" if status['eta'] is not None else "unknown"
+		return (
+			f"Downloading: {status['active']} active, {formatRate(status['bytes_per_second'])}, "
+			f"{status['remaining_bytes'] / 1024 ** 2:.1f} MiB left, ETA {eta}")
+
+	@contextmanager
+	def track(self, task_id):
+		# Yields a yt-dlp progress hook bound to one download
+		with self.lock:
+			self.flows[task_id] = Flow(ready_at=time.monotonic(), updated=time.monotonic())
+
+		def hook(progress):
+			if progress.get('status') == "downloading" and progress.get('downloaded_bytes') is not None:
+				self.consume(
+					task_id, progress['downloaded_bytes'], progress.get('total_bytes') or progress.get('total_bytes_estimate'))
+
+		try:
+			yield hook
+		finally:
+			with self.lock:
+				self.flows.pop(task_id, None)
@@ -0,0 +1,472 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import urlparse
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+CHUNK_SIZE = 16 * 1024
+FIXTURE_FREQUENCIES = [220, 330, 440, 550, 660, 770, 880, 990]
+REGRESSION_THRESHOLD = 0.10  # 10% slower than the baseline counts as a regression
+STARTUP_BUDGET = {'help': 0.5, 'validate': 1.5}  # seconds, median of STARTUP_RUNS fresh interpreters
+STARTUP_RUNS = 5
+STARTUP_ROWS = 1000
+HEAVY_MODULES = ("yt_dlp", "openpyxl", "numpy")  # must stay out of --help and sheet validation
+CHIRP_BASE, CHIRP_RATE = 200, 40  # Hz at 0:00 and Hz gained per second, so the pitch of a clip tells where it was cut
+CHIRP_SKIP, CHIRP_LISTEN = 0.05, 0.25  # seconds skipped past the encoder delay, then measured
+# Bounded windows, an open end and a window past the end of the fixture
+OFFSET_CASES = ["0:10-0:20; 0:30-0:40", "0:05-0:10; 0:20-", "0:42+6s", "0:55+10s"]
+OFFSET_TOLERANCE = 0.2  # seconds
+
+
+def generateFixtures(fixture_dir, count, duration):
+	os.makedirs(fixture_dir, exist_ok=True)
+	fixtures = []
+
+	for i in range(count):
+		fixture_path = os.path.join(fixture_dir, f"fixture-{i:03d}.webm")
+
+		if not os.path.exists(fixture_path):
+			frequency = FIXTURE_FREQUENCIES[i % len(FIXTURE_FREQUENCIES)]
+			command = [
+				"ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+				"-f", "lavfi", "-i", f"sine=frequency={frequency}:duration={duration}",
+				"-c:a", "libopus", "-b:a", "128k", fixture_path]
+			subprocess.run(command, check=True)
+
+		fixtures.append(fixture_path)
+
+	return fixtures
+
+
+def generateChirp(fixture_dir, duration):
+	os.makedirs(fixture_dir, exist_ok=True)
+	fixture_path = os.path.join(fixture_dir, f"chirp-{duration}.webm")
+
+	if not os.path.exists(fixture_path):
+		# The phase integrates CHIRP_BASE + CHIRP_RATE * t
+		command = [
+			"ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+			"-f", "lavfi", "-i", f"aevalsrc=sin(2*PI*({CHIRP_BASE}*t+{CHIRP_RATE / 2}*t*t)):s=48000:d={duration}",
+			"-c:a", "libopus", "-b:a", "128k", fixture_path]
+		subprocess.run(command, check=True)
+
+	return fixture_path
+
+
+def chirpTime(clip_path):
+	# Source time of the first sample of a clip cut from the chirp, from the frequency of its rising zero crossings
+	command = [
+		"ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-i", clip_path,
+		"-ss", str(CHIRP_SKIP), "-t", str(CHIRP_LISTEN), "-ac", "1", "-ar", "48000", "-f", "s16le", "-"]
+	samples = array("h", subprocess.run(command, capture_output=True, check=True).stdout)
+	crossings = [i + a / (a - b) for i, (a, b) in enumerate(zip(samples, samples[1:])) if a < 0 <= b]
+
+	if len(crossings) < 2:
+		return None
+
+	frequency = (len(crossings) - 1) * 48000 / (crossings[-1] - crossings[0])
+	# The measured frequency is the one in the middle of the listened stretch
+	return (frequency - CHIRP_BASE) / CHIRP_RATE - CHIRP_SKIP - CHIRP_LISTEN / 2
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+
+	def fixtureFor(self, video_id):
+		# Video IDs look like bench000042, so many rows can share a few fixtures
+		fixtures = self.server.fixtures
+		return fixtures[int(video_id[5:]) % len(fixtures)]
+
+	def sendInfo(self, video_id):
+		fixture_path = self.fixtureFor(video_id)
+		body = json.dumps({
+			'id': video_id,
+			'title': f"Bench {video_id}",
+			'duration': self.server.duration,
+			'filesize': os.path.getsize(fixture_path),
+		}).encode()
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def sendMedia(self, video_id, with_body=True):
+		fixture_path = self.fixtureFor(video_id)
+		size = os.path.getsize(fixture_path)
+		start, end = 0, size - 1
+		range_header = self.headers.get("Range")
+
+		if range_header and range_header.startswith("bytes="):
+			first, _, last = range_header[6:].partition("-")
+			start = int(first) if first else 0
+			end = min(int(last), size - 1) if last else size - 1
+			self.send_response(206)
+			self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+		else:
+			self.send_response(200)
+
+		self.send_header("Content-Type", "audio/webm")
+		self.send_header("Accept-Ranges", "bytes")
+		self.send_header("Content-Length", str(end - start + 1))
+		self.end_headers()
+
+		if not with_body:
+			return
+
+		with open(fixture_path, "rb") as fixture:
+			fixture.seek(start)
+			remaining = end - start + 1
+
+			while remaining > 0:
+				chunk = fixture.read(min(CHUNK_SIZE, remaining))
+
+				if not chunk:
+					break
+
+				self.wfile.write(chunk)
+				remaining -= len(chunk)
+
+				# Simulated link speed, per connection
+				if self.server.bandwidth:
+					time.sleep(len(chunk) / self.server.bandwidth)
+
+	def route(self, with_body):
+		time.sleep(self.server.latency)
+		kind, _, video_id = urlparse(self.path).path.strip("/").partition("/")
+
+		try:
+			if kind == "info":
+				self.sendInfo(video_id)
+			elif kind == "media":
+				self.sendMedia(video_id, with_body)
+			else:
+				self.send_error(404)
+		except (ConnectionError, ValueError):
+			# Readers such as ffmpeg hang up as soon as they have their range
+			pass
+
+	def do_GET(self):
+		self.route(True)
+
+	def do_HEAD(self):
+		self.route(False)
+
+	def log_message(self, *args):
+		pass
+
+
+class MediaServer(ThreadingHTTPServer):
+
+	daemon_threads = True
+
+	def __init__(self, fixtures, duration, bandwidth=0, latency=0.0, port=0):
+		super().__init__(("127.0.0.1", port), MediaHandler)
+		self.fixtures = fixtures
+		self.duration = duration
+		self.bandwidth = bandwidth
+		self.latency = latency
+
+	def start(self):
+		Thread(target=self.serve_forever, daemon=True).start()
+		return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+def patchYoutubeDL():
+	import yt_dlp
+	from yt_dlp.extractor.common import InfoExtractor
+
+	class BenchIE(InfoExtractor):
+		IE_NAME = "bench"
+		_VALID_URL = r'https?://127\.0\.0\.1:\d+/watch\?v=(?P<id>bench\d{6})'
+
+		def _real_extract(self, url):
+			video_id = self._match_id(url)
+			base_url = "{0.scheme}://{0.netloc}".format(urlparse(url))
+			info = self._download_json(f"{base_url}/info/{video_id}", video_id)
+
+			return {
+				'id': video_id,
+				'title': info['title'],
+				'duration': info['duration'],
+				'formats': [{
+					'format_id': "bench-opus",
+					'url': f"{base_url}/media/{video_id}",
+					'ext': "webm",
+					'acodec': "opus",
+					'vcodec': "none",
+					'filesize': info['filesize'],
+				}],
+			}
+
+	class BenchYoutubeDL(yt_dlp.YoutubeDL):
+
+		def __init__(self, *args, **kwargs):
+			super().__init__(*args, **kwargs)
+			self.add_info_extractor(BenchIE())
+
+		def extract_info(self, url, *args, **kwargs):
+			# Route bench URLs past the generic extractor
+			if BenchIE.suitable(url):
+				kwargs['ie_key'] = BenchIE.ie_key()
+
+			return super().extract_info(url, *args, **kwargs)
+
+	yt_dlp.YoutubeDL = BenchYoutubeDL
+
+
+def writeSheet(run_dir, base_url, rows, timestamps):
+	# timestamps is one window for every row, or a list with one per row
+	sheet_path = os.path.join(run_dir, "bench.csv")
+	row_timestamps = timestamps if isinstance(timestamps, list) else [timestamps] * rows
+
+	with open(sheet_path, "w", newline="") as sheet:
+		writer = csv.writer(sheet)
+		writer.writerow(["n", "reg", "folder", "url", "timestamps"])
+
+		for i in range(rows):
+			writer.writerow([i + 1, "", f"Student-{i:04d}", f"{base_url}/watch?v=bench{i:06d}", row_timestamps[i]])
+
+	config = {'sources': [{'path': "bench.csv", 'first_row': 2, 'routes': [{'rows': [2, rows + 1], 'dir': "out"}]}]}
+
+	with open(os.path.join(run_dir, "bench.json"), "w") as config_file:
+		json.dump(config, config_file)
+
+
+def runOnce(params):
+	# Runs inside a fresh interpreter whose working directory is the run directory
+	patchYoutubeDL()
+	import main
+
+	main.HOST_BURST = 1000
+	main.METRICS_TEXTFILE = None
+	main.RANGE_DOWNLOAD = params.get('range_download', main.RANGE_DOWNLOAD)
+	budget = ["--bandwidth", params['budget']] if params.get('budget') else []
+	main.main([
+		"run", "--config", "bench.json", "--downloads", str(params['workers']), "--host-rate", "1000",
+		"--trim-mode", params['trim_mode'], "--profile", params['profile']] + budget)
+
+	with open(main.METRICS_PATH) as metrics_file:
+		summary = [json.loads(line) for line in metrics_file][-1]
+
+	print(json.dumps({'summary': summary, 'failures': len(main.failures)}))
+
+
+def runPipeline(run_dir, params):
+	env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SRC_DIR, os.environ.get("PYTHONPATH")])))
+	result = subprocess.run(
+		[sys.executable, "-c", f"import bench; bench.runOnce({params!r})"],
+		cwd=run_dir, env=env, capture_output=True, text=True)
+
+	if result.returncode != 0:
+		raise RuntimeError(f"Benchmark run failed: {result.stderr.strip()}")
+
+	return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def benchmark(base_url, params, timestamps):
+	with tempfile.TemporaryDirectory(prefix="yt-audio-bench-") as run_dir:
+		writeSheet(run_dir, base_url, params['rows'], timestamps)
+		started = time.monotonic()
+		outcome = runPipeline(run_dir, params)
+		wall = time.monotonic() - started
+
+	return dict(
+		params, wall=round(wall, 3), rows_per_second=round(params['rows'] / wall, 3),
+		failures=outcome['failures'], stages=outcome['summary']['stages'])
+
+
+def offsetCheck(fixture_dir, duration):
+	# Every clip must start at its window in the source, with range downloads on and off
+	from timestamps import parseWindows
+	from trim import probeMedia
+
+	server = MediaServer([generateChirp(fixture_dir, duration)], duration)
+	base_url = server.start()
+	wrong = 0
+
+	try:
+		for range_download in (True, False):
+			with tempfile.TemporaryDirectory(prefix="yt-audio-offsets-") as run_dir:
+				writeSheet(run_dir, base_url, len(OFFSET_CASES), OFFSET_CASES)
+				params = {
+					'rows': len(OFFSET_CASES), 'workers': 4, 'trim_mode': "accurate", 'profile': "mp3", 'budget': None,
+					'range_download': range_download}
+
+				if runPipeline(run_dir, params)['failures']:
+					raise RuntimeError(f"Offset check run failed, see {run_dir}/failures.json")
+
+				for row, timestamps in enumerate(OFFSET_CASES):
+					folder = os.path.join(run_dir, "out", f"Student-{row:04d}")
+
+					# Clips sort as _trim1, _trim2, ... in window order
+					for clip, (start, end) in zip(sorted(os.listdir(folder)), parseWindows(timestamps)):
+						end = min(end, duration) if end is not None else duration
+						clip_path = os.path.join(folder, clip)
+						measured = chirpTime(clip_path)
+						length = probeMedia(clip_path)['duration'] or 0
+						failed = (
+							measured is None or abs(measured - start) > OFFSET_TOLERANCE
+							or abs(length - (end - start)) > OFFSET_TOLERANCE)
+						wrong += failed
+						print(
+							f"{'OFF' if failed else 'ok':>4}  range_download={range_download} {timestamps!r} "
+							f"window {start}-{end}: starts at {measured if measured is None else round(measured, 2)}s, "
+							f"{length:.2f}s long")
+	finally:
+		server.shutdown()
+
+	return 1 if wrong else 0
+
+
+def startupCheck():
+	commands = {
+		'help': ["--help"],
+		'validate': ["resolve", "--offline", "--config", "bench.json"],
+	}
+	over_budget = False
+
+	with tempfile.TemporaryDirectory(prefix="yt-audio-startup-") as run_dir:
+		writeSheet(run_dir, "http://127.0.0.1:1", STARTUP_ROWS, "0:05-0:35")
+		env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SRC_DIR, os.environ.get("PYTHONPATH")])))
+
+		for name, command_args in commands.items():
+			# Report which heavy modules the command pulled in, after it exits
+			script = (
+				"import sys, main\n"
+				f"try: main.main({command_args!r})\n"
+				"except SystemExit: pass\n"
+				f"print('HEAVY:' + ','.join(module for module in {HEAVY_MODULES!r} if module in sys.modules))")
+			timings = []
+
+			for _ in range(STARTUP_RUNS):
+				started = time.monotonic()
+				result = subprocess.run(
+					[sys.executable, "-c", script], cwd=run_dir, env=env, capture_output=True, text=True)
+				timings.append(time.monotonic() - started)
+
+				if result.returncode != 0:
+					raise RuntimeError(f"Startup check {name} failed: {result.stderr.strip()}")
+
+			median = sorted(timings)[len(timings) // 2]
+			heavy = result.stdout.rstrip("\n").splitlines()[-1].removeprefix("HEAVY:")
+			failed = median > STARTUP_BUDGET[name] or heavy
+			over_budget = over_budget or failed
+			print(
+				f"{'OVER' if failed else 'ok':>4}  {name}: {median:.3f}s (budget {STARTUP_BUDGET[name]}s)"
+				+ (f", imported {heavy}" if heavy else ""))
+
+	return 1 if over_budget else 0
+
+
+def gitVersion():
+	result = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=SRC_DIR, capture_output=True, text=True)
+	return result.stdout.strip() or "unknown"
+
+
+def configKey(result):
+	return (result['rows'], result['workers'], result['trim_mode'], result['profile'])
+
+
+def compareResults(baseline, current):
+	previous = {configKey(result): result for result in baseline['results']}
+	regressions = []
+
+	for result in current['results']:
+		before = previous.get(configKey(result))
+
+		if before is None:
+			continue
+
+		change = result['wall'] / before['wall'] - 1
+		marker = "REGRESSION" if change > REGRESSION_THRESHOLD else "ok"
+		print(
+			f"{marker:>10}  rows={result['rows']} workers={result['workers']} trim={result['trim_mode']} "
+			f"profile={result['profile']}: {before['wall']:.2f}s -> {result['wall']:.2f}s ({change:+.0%})")
+
+		if marker == "REGRESSION":
+			regressions.append(result)
+
+	return regressions
+
+
+def parseArgs(argv=None):
+	parser = argparse.ArgumentParser(prog="bench.py", description="Offline pipeline benchmark")
+	parser.add_argument("--rows", type=int, nargs="+", default=[10, 100])
+	parser.add_argument("--workers", type=int, nargs="+", default=[4, 10])
+	parser.add_argument("--trim-modes", nargs="+", default=["copy", "accurate"])
+	parser.add_argument("--profiles", nargs="+", default=["mp3", "original"])
+	parser.add_argument("--fixtures", type=int, default=8, help="distinct synthetic sources")
+	parser.add_argument("--duration", type=int, default=60, help="fixture length in seconds")
+	parser.add_argument("--timestamps", default="0:05-0:35", help="window cut from every row, empty for none")
+	parser.add_argument("--bandwidth", type=int, default=0, help="bytes per second per connection, 0 is unlimited")
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response")
+	parser.add_argument("--budget", help="global download bandwidth ceiling passed to run, e.g. 2M")
+	parser.add_argument("--fixture-dir", default=os.path.join(tempfile.gettempdir(), "yt-audio-bench-fixtures"))
+	parser.add_argument("--output", default="bench-results.json")
+	parser.add_argument("--compare", help="earlier results file to compare against")
+	parser.add_argument("--startup", action="store_true", help="only check CLI start-up time against STARTUP_BUDGET")
+	parser.add_argument("--offsets", action="store_true", help="only check that clips start where their windows do")
+	return parser.parse_args(argv)
+
+
+def main(argv=None):
+	args = parseArgs(argv)
+
+	if args.startup:
+		return startupCheck()
+
+	if args.offsets:
+		return offsetCheck(args.fixture_dir, args.duration)
+
+	fixtures = generateFixtures(args.fixture_dir, args.fixtures, args.duration)
+	server = MediaServer(fixtures, args.duration, args.bandwidth, args.latency)
+	base_url = server.start()
+	results = []
+
+	try:
+		for rows, workers, trim_mode, profile in itertools.product(args.rows, args.workers, args.trim_modes, args.profiles):
+			params = {'rows': rows, 'workers': workers, 'trim_mode': trim_mode, 'profile': profile, 'budget': args.budget}
+			result = benchmark(base_url, params, args.timestamps)
+			results.append(result)
+			print(
+				f"rows={rows} workers={workers} trim={trim_mode} profile={profile}: "
+				f"{result['wall']:.2f}s, {result['rows_per_second']:.1f} rows/s, {result['failures']} failures")
+	finally:
+		server.shutdown()
+
+	report = {
+		'version': gitVersion(),
+		'time': time.time(),
+		'python': platform.python_version(),
+		'bandwidth': args.bandwidth,
+		'latency': args.latency,
+		'budget': args.budget,
+		'results': results,
+	}
+
+	with open(args.output, "w") as output:
+		json.dump(report, output, indent=2)
+
+	print(f"Benchmark results saved: {args.output}")
+
+	if args.compare:
+		with open(args.compare) as baseline_file:
+			regressions = compareResults(json.load(baseline_file), report)
+
+		return 1 if regressions else 0
+
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
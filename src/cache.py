@@ -0,0 +1,175 @@
+import fcntl
+import json
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+# ioctl request used by Linux filesystems that support copy-on-write clones
+FICLONE = 0x40049409
+
+VIDEO_ID_PATTERNS = [
+	r'(?:v=|/v/|/embed/|/shorts/|/live/)([A-Za-z0-9_-]{11})',
+	r'youtu\.be/([A-Za-z0-9_-]{11})',
+]
+
+
+def extractVideoId(yt_url):
+	for pattern in VIDEO_ID_PATTERNS:
+		match = re.search(pattern, str(yt_url))
+
+		if match:
+			return match.group(1)
+
+	return None
+
+
+def cacheKey(video_id, audio_format, quality, section=None):
+	key = f"{video_id}-{audio_format}-{quality}"
+
+	if section:
+		key += "-{:g}-{:g}".format(*section)
+
+	return key
+
+
+def linkFile(src_path, dst_path):
+	if os.path.exists(dst_path):
+		os.remove(dst_path)
+
+	try:
+		os.link(src_path, dst_path)
+		return "hardlink"
+	except OSError:
+		pass
+
+	try:
+		with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+			fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+		return "reflink"
+	except OSError:
+		if os.path.exists(dst_path):
+			os.remove(dst_path)
+
+	# A copy is written under a temporary name so a crash never leaves half a file in place
+	shutil.copy2(src_path, dst_path + ".tmp")
+	os.replace(dst_path + ".tmp", dst_path)
+	return "copy"
+
+
+@contextmanager
+def fileLock(lock_path):
+	# Serialises read-modify-write of index files shared by several processes or hosts.
+	# flock works across hosts on NFS, where Linux maps it to a POSIX lock.
+	with open(lock_path, "a") as lock_file:
+		fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+		try:
+			yield
+		finally:
+			fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class DownloadCache:
+
+	def __init__(self, cache_dir, max_bytes):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.index_path = os.path.join(cache_dir, "index.json")
+		self.lock_path = os.path.join(cache_dir, "index.lock")
+		self.lock = Lock()
+
+		os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+		self.index = self.readIndex()
+
+	def readIndex(self):
+		try:
+			with open(self.index_path) as index_file:
+				return json.load(index_file)
+		except (OSError, ValueError):
+			return {}
+
+	def writeIndex(self):
+		tmp_path = self.index_path + ".tmp"
+
+		with open(tmp_path, "w") as index_file:
+			json.dump(self.index, index_file, indent=1)
+
+		os.replace(tmp_path, self.index_path)
+
+	@contextmanager
+	def shared(self):
+		# Other workers may have stored or evicted since the last look, so the index is read again under the lock
+		with self.lock, fileLock(self.lock_path):
+			self.index = self.readIndex()
+			yield
+
+	def objectPath(self, key, ext):
+		return os.path.join(self.cache_dir, "objects", key[:2], f"{key}.{ext}")
+
+	def lookup(self, key, link_to=None):
+		# With link_to the object is also linked to link_to.<ext> under the same lock,
+		# so an eviction by another worker cannot slip in between finding the entry and using it
+		with self.shared():
+			entry = self.index.get(key)
+
+			if entry is None:
+				return None
+
+			object_path = self.objectPath(key, entry['ext'])
+
+			if not os.path.exists(object_path):
+				del self.index[key]
+				self.writeIndex()
+				return None
+
+			entry['last_used'] = time.time()
+			self.writeIndex()
+			found = dict(entry)
+
+			if link_to:
+				found['path'] = f"{link_to}.{entry['ext']}"
+				found['link'] = linkFile(object_path, found['path'])
+
+			return found
+
+	def covering(self, video_id, start, end=None):
+		# Keys of cached sources of video_id that span start..end, smallest first. An end of None, for the
+		# entry or the request, is the end of the video. The index in memory is only a hint for lookup.
+		with self.lock:
+			found = [
+				(entry['size'], key) for key, entry in self.index.items()
+				if entry.get('video_id') == video_id and entry['start'] <= start
+				and (entry['end'] is None or end is not None and entry['end'] >= end)]
+
+		return [key for _, key in sorted(found)]
+
+	def store(self, key, src_path, **meta):
+		ext = os.path.splitext(src_path)[1].lstrip(".")
+		object_path = self.objectPath(key, ext)
+		os.makedirs(os.path.dirname(object_path), exist_ok=True)
+
+		with self.shared():
+			linkFile(src_path, object_path)
+			self.index[key] = dict(meta, ext=ext, size=os.path.getsize(object_path), last_used=time.time())
+			self.evict()
+			self.writeIndex()
+
+	def evict(self):
+		total = sum(entry['size'] for entry in self.index.values())
+
+		# least recently used entries go first
+		for key, entry in sorted(self.index.items(), key=lambda item: item[1]['last_used']):
+			if total <= self.max_bytes:
+				break
+
+			object_path = self.objectPath(key, entry['ext'])
+
+			if os.path.exists(object_path):
+				os.remove(object_path)
+
+			total -= entry['size']
+			del self.index[key]
+
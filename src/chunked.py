@@ -0,0 +1,216 @@
+import http.client
+import os
+import re
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from threading import Lock
+from urllib.parse import urljoin, urlsplit
+
+BLOCK_SIZE = 256 * 1024
+MAX_REDIRECTS = 5
+CHUNK_RETRIES = 3  # per chunk, on top of the task-level retries in retry.py
+GROWTH = 1.15  # another connection is only added while it raises throughput by 15%
+
+
+class ChunkError(Exception):
+
+	def __init__(self, cause, offset):
+		super().__init__(str(cause))
+		self.offset = offset  # the chunk is complete up to here and resumes from it
+
+
+class NoRangeSupport(RuntimeError):
+	pass
+
+
+class ChunkedDownload:
+
+	def __init__(self, url, dst_path, headers=None, connections=4, max_connections=16, min_chunk=1024 ** 2,
+			max_chunk=32 * 1024 ** 2, chunk_seconds=4, timeout=30, progress=None):
+		self.url = url
+		self.dst_path = dst_path
+		self.headers = dict(headers or {})
+		self.connections = connections
+		self.max_connections = max_connections
+		self.min_chunk = min_chunk
+		self.max_chunk = max_chunk
+		self.chunk_seconds = chunk_seconds  # a chunk should take about this long on one connection
+		self.timeout = timeout
+		self.progress = progress  # progress(downloaded, total), may sleep to pace the download
+		self.lock = Lock()
+		self.progress_lock = Lock()
+		self.size = None
+		self.next_offset = 0
+		self.retries = []  # (start, end, attempt) of chunks that failed part-way
+		self.downloaded = 0
+		self.connection_rates = []
+		self.failed = False
+
+	def connect(self, url):
+		parts = urlsplit(url)
+		connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+		return connection_class(parts.netloc, timeout=self.timeout)
+
+	def request(self, connection, start, end):
+		parts = urlsplit(self.url)
+		path = parts.path + (f"?{parts.query}" if parts.query else "")
+		connection.request("GET", path, headers=dict(self.headers, Range=f"bytes={start}-{end}"))
+		return connection.getresponse()
+
+	def probe(self):
+		# A one-byte range request gives the size and proves the server honours ranges
+		for _ in range(MAX_REDIRECTS):
+			connection = self.connect(self.url)
+
+			try:
+				response = self.request(connection, 0, 0)
+				response.read()
+			finally:
+				connection.close()
+
+			if response.status in (301, 302, 303, 307, 308):
+				self.url = urljoin(self.url, response.getheader("Location"))
+				continue
+
+			# A whole-file 200 means the server ignores ranges, the caller falls back to a single stream
+			if response.status == 200:
+				raise NoRangeSupport("Server ignores range requests")
+
+			if response.status != 206:
+				raise RuntimeError(f"HTTP Error {response.status}: chunked download probe failed")
+
+			match = re.match(r'bytes 0-0/(\d+)', response.getheader("Content-Range", ""))
+
+			if not match:
+				raise RuntimeError("Chunked download needs a known length")
+
+			return int(match.group(1))
+
+		raise RuntimeError("Too many redirects")
+
+	def chunkSize(self):
+		# Sized from the measured per-connection throughput, split further near the end so no connection idles
+		rate = sorted(self.connection_rates)[len(self.connection_rates) // 2] if self.connection_rates else 0
+		size = min(self.max_chunk, max(self.min_chunk, int(rate * self.chunk_seconds)))
+		remaining = self.size - self.next_offset
+		return max(self.min_chunk, min(size, remaining // self.connections + 1))
+
+	def nextChunk(self):
+		with self.lock:
+			if self.failed:
+				return None
+
+			if self.retries:
+				return self.retries.pop()
+
+			if self.next_offset >= self.size:
+				return None
+
+			start = self.next_offset
+			end = min(self.size, start + self.chunkSize()) - 1
+			self.next_offset = end + 1
+			return start, end, 0
+
+	def fetchChunk(self, connection, fd, start, end):
+		offset = start
+
+		try:
+			response = self.request(connection, start, end)
+
+			if response.status != 206 or not response.getheader("Content-Range", "").startswith(f"bytes {start}-"):
+				response.read()
+				raise RuntimeError(f"HTTP Error {response.status}: bad range response for bytes {start}-{end}")
+
+			buffer = bytearray(BLOCK_SIZE)
+			view = memoryview(buffer)
+			started = time.monotonic()
+
+			while offset <= end:
+				read = response.readinto(view[:min(BLOCK_SIZE, end + 1 - offset)])
+
+				if not read:
+					raise http.client.IncompleteRead(b"", end + 1 - offset)
+
+				# Written straight to its place in the preallocated file, no reassembly pass
+				os.pwrite(fd, view[:read], offset)
+				offset += read
+
+				with self.progress_lock:
+					self.downloaded += read
+
+					if self.progress:
+						self.progress(self.downloaded, self.size)
+
+			with self.lock:
+				self.connection_rates = (self.connection_rates + [(end + 1 - start) / (time.monotonic() - started)])[-32:]
+		except (OSError, http.client.HTTPException, RuntimeError) as error:
+			raise ChunkError(error, offset) from error
+
+	def worker(self, fd):
+		connection = None
+
+		try:
+			while (chunk := self.nextChunk()) is not None:
+				start, end, attempt = chunk
+				connection = connection or self.connect(self.url)
+
+				try:
+					self.fetchChunk(connection, fd, start, end)
+				except ChunkError as error:
+					# The connection may be half-read, so the retry opens a fresh one
+					connection.close()
+					connection = None
+
+					if attempt + 1 >= CHUNK_RETRIES:
+						with self.lock:
+							self.failed = True
+						raise
+
+					with self.lock:
+						self.retries.append((error.offset, end, attempt + 1))
+		finally:
+			if connection:
+				connection.close()
+
+	def run(self):
+		self.size = self.probe()
+		fd = os.open(self.dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+		try:
+			# Preallocated up front, so chunks land in place and a full disk fails before any download
+			if hasattr(os, "posix_fallocate"):
+				os.posix_fallocate(fd, 0, self.size)
+			else:
+				os.ftruncate(fd, self.size)
+
+			with ThreadPoolExecutor(self.max_connections) as pool:
+				futures = {pool.submit(self.worker, fd) for _ in range(self.connections)}
+				best_rate = 0.0
+				checked_at, checked_bytes = time.monotonic(), 0
+
+				while futures:
+					done, futures = wait(futures, timeout=self.chunk_seconds, return_when=FIRST_EXCEPTION)
+
+					for future in done:
+						future.result()
+
+					now = time.monotonic()
+					rate = (self.downloaded - checked_bytes) / (now - checked_at)
+					checked_at, checked_bytes = now, self.downloaded
+
+					# Per-connection throttling shows up as throughput that keeps rising with each connection
+					if futures and len(futures) < self.max_connections and rate > best_rate * GROWTH \
+							and self.size - self.next_offset > self.min_chunk * len(futures):
+						best_rate = rate
+						self.connections = len(futures) + 1
+						futures.add(pool.submit(self.worker, fd))
+
+			if self.downloaded != self.size or os.fstat(fd).st_size != self.size:
+				raise RuntimeError(f"Chunked download incomplete: {self.downloaded} of {self.size} bytes")
+		except BaseException:
+			os.close(fd)
+			os.remove(self.dst_path)
+			raise
+
+		os.close(fd)
+		return self.size
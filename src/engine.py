@@ -0,0 +1,328 @@
+import asyncio
+import heapq
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urlparse
+from retry import TRANSIENT, retryAsync
+
+THROTTLE_MARKERS = ("429", "too many requests", "rate limit", "rate-limit")
+
+# Aliases of the same origin share one rate limit
+HOST_ALIASES = {
+	"youtu.be": "youtube.com",
+	"m.youtube.com": "youtube.com",
+	"music.youtube.com": "youtube.com",
+	"www.youtube.com": "youtube.com",
+}
+
+
+def hostOf(url):
+	host = urlparse(str(url)).netloc.lower().split(":")[0]
+	return HOST_ALIASES.get(host, host)
+
+
+def isThrottle(error):
+	message = str(error).lower()
+	return any(marker in message for marker in THROTTLE_MARKERS)
+
+
+class TokenBucket:
+
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated = time.monotonic()
+		self.lock = Lock()
+
+	def acquire(self):
+		# Blocks the calling stage thread, waiters take their turn under the lock
+		with self.lock:
+			while True:
+				now = time.monotonic()
+				self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+
+				time.sleep((1 - self.tokens) / self.rate)
+
+
+class HostLimiter:
+
+	def __init__(self, rate=1.0, burst=5):
+		self.rate = rate
+		self.burst = burst
+		self.buckets = {}
+		self.lock = Lock()
+
+	def acquire(self, url):
+		# Taken right before a request goes out, so rows served from a cache never wait for a token
+		with self.lock:
+			host = hostOf(url)
+
+			if host not in self.buckets:
+				self.buckets[host] = TokenBucket(self.rate, self.burst)
+
+			bucket = self.buckets[host]
+
+		bucket.acquire()
+
+
+class AdaptiveLimiter:
+
+	def __init__(self, limit, cooldown=30, increase_after=5):
+		self.maximum = limit
+		self.limit = limit
+		self.cooldown = cooldown
+		self.increase_after = increase_after
+		self.active = 0
+		self.successes = 0
+		self.resume_at = 0
+		self.condition = asyncio.Condition()
+
+	async def __aenter__(self):
+		# After throttling nobody starts until the cooldown has passed
+		while (delay := self.resume_at - time.monotonic()) > 0:
+			await asyncio.sleep(delay)
+
+		async with self.condition:
+			await self.condition.wait_for(lambda: self.active < self.limit)
+			self.active += 1
+
+	async def __aexit__(self, *exc_info):
+		async with self.condition:
+			self.active -= 1
+			self.condition.notify_all()
+
+	def throttled(self):
+		# Multiplicative decrease, additive increase
+		self.limit = max(1, self.limit // 2)
+		self.successes = 0
+		self.resume_at = time.monotonic() + self.cooldown
+
+	def succeeded(self):
+		self.successes += 1
+
+		if self.successes >= self.increase_after and self.limit < self.maximum:
+			self.limit += 1
+			self.successes = 0
+
+
+def makespan(durations, workers):
+	# Greedy list scheduling: each job goes to the worker that frees up first
+	finish_times = [0.0] * max(1, workers)
+
+	for duration in durations:
+		heapq.heappush(finish_times, heapq.heappop(finish_times) + duration)
+
+	return max(finish_times)
+
+
+class Engine:
+
+	def __init__(self, download, trim, on_error, resolve=None, resolve_workers=8, max_downloads=10,
+			throttle_cooldown=30, max_attempts=4, backoff_base=2.0, backoff_cap=60.0,
+			trim_workers=4, trim_queue_size=8, queue_size=40, task_url=lambda task: task.url,
+			job_task=lambda job: job.task, metrics=None, task_id=id, task_cost=None, download_key=None):
+		self.download = download
+		self.trim = trim
+		self.on_error = on_error
+		self.resolve = resolve
+		self.resolve_workers = resolve_workers
+		self.max_downloads = max_downloads
+		self.throttle_cooldown = throttle_cooldown
+		self.max_attempts = max_attempts
+		self.backoff_base = backoff_base
+		self.backoff_cap = backoff_cap
+		self.trim_workers = trim_workers
+		self.trim_queue_size = trim_queue_size
+		self.queue_size = queue_size
+		self.task_url = task_url
+		self.job_task = job_task
+		self.metrics = metrics
+		self.task_id = task_id
+		self.task_cost = task_cost  # expected seconds of work, longest first; None keeps sheet order
+		self.download_key = download_key  # rows with the same key share one download
+		self.sequence = itertools.count()
+		self.waiting = {}
+		self.arrival = {}
+		self.download_times = []
+		self.stats = {
+			'download_blocked': 0.0, 'trim_idle': 0.0, 'trim_queue_peak': 0, 'throttled': 0, 'retries': 0,
+			'coalesced': 0}
+
+	def priority(self, task):
+		if self.task_cost is None:
+			return 0
+
+		# Unknown costs sort as the longest, so surprises start early
+		cost = self.task_cost(task)
+		return -(cost if cost is not None else float("inf"))
+
+	async def dequeue(self, queue, stage):
+		# Items travel with their enqueue time so queue wait can be measured per stage
+		_, _, enqueued_at, item = await queue.get()
+
+		if self.metrics:
+			task = self.job_task(item) if stage == "transcode" else item
+			self.metrics.queueWait(stage, self.task_id(task), time.monotonic() - enqueued_at)
+
+		return item
+
+	async def enqueue(self, queue, item, priority=0):
+		# The sequence number keeps equal priorities in arrival order
+		await queue.put((priority, next(self.sequence), time.monotonic(), item))
+
+	def attemptFailed(self, stage, task, error, category, attempt):
+		if self.metrics:
+			self.metrics.retry(stage, self.task_id(task), category, attempt)
+
+		if isThrottle(error):
+			self.limiter.throttled()
+			self.stats['throttled'] += 1
+
+		if category == TRANSIENT and attempt < self.max_attempts:
+			self.stats['retries'] += 1
+
+	async def resolveWorker(self, resolve_queue, download_queue, pool):
+		loop = asyncio.get_running_loop()
+
+		while True:
+			task = await self.dequeue(resolve_queue, "resolve")
+
+			async def attempt():
+				return await loop.run_in_executor(pool, self.resolve, task)
+
+			try:
+				# Bad rows fail here, before any media is downloaded
+				resolved = await retryAsync(
+					attempt, self.max_attempts, self.backoff_base, self.backoff_cap,
+					lambda *failure: self.attemptFailed("resolve", task, *failure))
+				# Metadata is known from here on, so the download queue can put long jobs first
+				await self.enqueue(download_queue, resolved, self.priority(resolved))
+			except Exception as error:
+				self.on_error(task, error)
+			finally:
+				resolve_queue.task_done()
+
+	async def fetch(self, task, trim_queue, pool):
+		loop = asyncio.get_running_loop()
+
+		async def attempt():
+			async with self.limiter:
+				return await loop.run_in_executor(pool, self.download, task)
+
+		try:
+			started = time.monotonic()
+			job = await retryAsync(
+				attempt, self.max_attempts, self.backoff_base, self.backoff_cap,
+				lambda *failure: self.attemptFailed("download", task, *failure))
+			self.limiter.succeeded()
+			self.download_times.append((self.arrival.get(id(task), 0), self.priority(task), time.monotonic() - started))
+
+			if job is not None:
+				# Blocks while the trim stage is saturated
+				waited = time.monotonic()
+				await self.enqueue(trim_queue, job, self.priority(task))
+				self.stats['download_blocked'] += time.monotonic() - waited
+				self.stats['trim_queue_peak'] = max(self.stats['trim_queue_peak'], trim_queue.qsize())
+
+		except Exception as error:
+			self.on_error(task, error)
+
+	async def downloadWorker(self, download_queue, trim_queue, pool):
+		while True:
+			task = await self.dequeue(download_queue, "download")
+			key = self.download_key(task) if self.download_key else None
+
+			if key is not None and key in self.waiting:
+				# The same download is already in flight, so this row rides on it
+				self.waiting[key].append(task)
+				self.stats['coalesced'] += 1
+				download_queue.task_done()
+				continue
+
+			if key is not None:
+				self.waiting[key] = []
+
+			try:
+				await self.fetch(task, trim_queue, pool)
+			finally:
+				followers = self.waiting.pop(key, []) if key is not None else []
+
+			try:
+				# Followers are served from the cache the leader just filled when it covers them,
+				# otherwise, or if it failed, they download on their own
+				for follower in followers:
+					await self.fetch(follower, trim_queue, pool)
+			finally:
+				download_queue.task_done()
+
+	async def trimWorker(self, trim_queue, pool):
+		loop = asyncio.get_running_loop()
+
+		while True:
+			waited = time.monotonic()
+			job = await self.dequeue(trim_queue, "transcode")
+			self.stats['trim_idle'] += time.monotonic() - waited
+
+			try:
+				await loop.run_in_executor(pool, self.trim, job)
+			except Exception as error:
+				self.on_error(self.job_task(job), error)
+			finally:
+				trim_queue.task_done()
+
+	async def produce(self, tasks, queue):
+		loop = asyncio.get_running_loop()
+		iterator = iter(tasks)
+
+		# The sheet reader runs on its own thread and stalls while the queue is full
+		with ThreadPoolExecutor(1) as reader:
+			while (task := await loop.run_in_executor(reader, next, iterator, None)) is not None:
+				self.arrival[id(task)] = len(self.arrival)
+				await self.enqueue(queue, task)
+
+	async def run(self, tasks):
+		self.limiter = AdaptiveLimiter(self.max_downloads, self.throttle_cooldown)
+		resolve_queue = asyncio.PriorityQueue(maxsize=self.queue_size)
+		download_queue = asyncio.PriorityQueue(maxsize=self.queue_size)
+		trim_queue = asyncio.PriorityQueue(maxsize=self.trim_queue_size)
+		resolve_workers = self.resolve_workers if self.resolve else 0
+
+		# Separate pools so blocking downloads never hold up ffmpeg and vice versa
+		with ThreadPoolExecutor(max(1, resolve_workers)) as resolve_pool, \
+				ThreadPoolExecutor(self.max_downloads) as download_pool, \
+				ThreadPoolExecutor(self.trim_workers) as trim_pool:
+			workers = [asyncio.create_task(self.trimWorker(trim_queue, trim_pool)) for _ in range(self.trim_workers)]
+			workers += [
+				asyncio.create_task(self.downloadWorker(download_queue, trim_queue, download_pool))
+				for _ in range(self.max_downloads)]
+			workers += [
+				asyncio.create_task(self.resolveWorker(resolve_queue, download_queue, resolve_pool))
+				for _ in range(resolve_workers)]
+
+			try:
+				await self.produce(tasks, resolve_queue if self.resolve else download_queue)
+				await resolve_queue.join()
+				await download_queue.join()
+				await trim_queue.join()
+			finally:
+				# Workers idle on empty queues once everything is done, so they are cancelled instead of sent sentinels
+				for worker in workers:
+					worker.cancel()
+
+				await asyncio.gather(*workers, return_exceptions=True)
+
+		self.stats['final_limit'] = self.limiter.limit
+
+		# Download-stage makespan of the measured download times, replayed in sheet order and longest first
+		in_order = [duration for _, _, duration in sorted(self.download_times)]
+		longest_first = [duration for _, _, duration in sorted(self.download_times, key=lambda item: item[1])]
+		self.stats['makespan_sheet_order'] = makespan(in_order, self.max_downloads)
+		self.stats['makespan_longest_first'] = makespan(longest_first, self.max_downloads)
@@ -0,0 +1,214 @@
+import sqlite3
+import subprocess
+import time
+from collections import Counter
+
+SAMPLE_RATE = 5512  # Hz, mono; the bands below only reach 2 kHz
+FRAME_SIZE = 2048  # samples, about 0.37 s
+HOP_SIZE = 64  # samples, about 86 sub-fingerprints per second; 31/32 overlap keeps misaligned uploads close
+BAND_EDGES = (300, 2000)  # Hz, 33 log-spaced bands give 32 bits per frame
+FRAMES_PER_BLOCK = 1024  # frames per FFT batch, bounds memory on hour-long sources
+INDEX_STRIDE = 4  # every 4th sub-fingerprint is indexed, every one is looked up, so any alignment still hits
+MAX_BIT_ERROR_RATE = 0.35  # unrelated audio sits near 0.5
+MIN_OVERLAP = 128  # frames, about 3 s compared before a match is trusted
+CANDIDATES = 5  # best-voted (source, alignment) pairs checked bit by bit
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+	id INTEGER PRIMARY KEY,
+	video_id TEXT NOT NULL,
+	url TEXT,
+	title TEXT,
+	cache_key TEXT,
+	start_sec REAL NOT NULL,
+	end_sec REAL NOT NULL,
+	fingerprint BLOB NOT NULL,
+	added REAL
+);
+CREATE INDEX IF NOT EXISTS sources_video ON sources (video_id);
+CREATE TABLE IF NOT EXISTS postings (hash INTEGER NOT NULL, source INTEGER NOT NULL, position INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS postings_hash ON postings (hash);
+CREATE TABLE IF NOT EXISTS aliases (
+	video_id TEXT PRIMARY KEY,
+	canonical TEXT NOT NULL,
+	delta REAL NOT NULL,
+	bit_error_rate REAL NOT NULL
+);
+"""
+
+
+def decodePcm(file_path):
+	# ffmpeg resamples to mono 16-bit PCM, which is all the fingerprint needs
+	import numpy as np
+
+	command = [
+		"ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-nostdin", "-i", file_path,
+		"-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-"]
+	result = subprocess.run(command, capture_output=True)
+
+	if result.returncode != 0:
+		raise RuntimeError(f"ffmpeg failed: {result.stderr.decode(errors='replace').strip()}")
+
+	return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768
+
+
+def fingerprint(samples):
+	# Haitsma-Kalker: one bit per band and frame, set when the energy difference between
+	# neighbouring bands grows from one frame to the next. Survives re-encoding and volume changes.
+	import numpy as np
+	from numpy.lib.stride_tricks import sliding_window_view
+
+	if len(samples) < FRAME_SIZE + HOP_SIZE:
+		return np.zeros(0, dtype=np.uint32)
+
+	frames = sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+	window = np.hanning(FRAME_SIZE).astype(np.float32)
+	frequencies = np.fft.rfftfreq(FRAME_SIZE, 1 / SAMPLE_RATE)
+	edges = np.geomspace(*BAND_EDGES, 34)
+	band_of = np.digitize(frequencies, edges) - 1
+	in_band = (band_of >= 0) & (band_of < 33)
+	energies = np.empty((len(frames), 33), dtype=np.float32)
+
+	for first in range(0, len(frames), FRAMES_PER_BLOCK):
+		spectrum = np.abs(np.fft.rfft(frames[first:first + FRAMES_PER_BLOCK] * window, axis=1)) ** 2
+		# Summed per band in one pass over all frames of the block
+		energies[first:first + FRAMES_PER_BLOCK] = np.add.reduceat(
+			spectrum[:, in_band], np.searchsorted(band_of[in_band], np.arange(33)), axis=1)
+
+	band_difference = energies[:, :-1] - energies[:, 1:]
+	bits = (band_difference[1:] - band_difference[:-1]) > 0
+	return np.packbits(bits, axis=1, bitorder="little").view("<u4").ravel()
+
+
+def bitErrorRate(first, second):
+	import numpy as np
+
+	differing = np.unpackbits((first ^ second).view(np.uint8)).sum()
+	return differing / (32 * len(first))
+
+
+class FingerprintIndex:
+
+	def __init__(self, index_path):
+		self.index_path = index_path
+		connection = self.connect()
+
+		try:
+			connection.executescript(SCHEMA)
+		finally:
+			connection.close()
+
+	def connect(self):
+		return sqlite3.connect(self.index_path, timeout=60)
+
+	def add(self, video_id, prints, start=0.0, url=None, title=None, cache_key=None):
+		end = start + (len(prints) * HOP_SIZE + FRAME_SIZE) / SAMPLE_RATE
+		connection = self.connect()
+
+		try:
+			with connection:
+				# A source fingerprinted again replaces its earlier entry
+				stale = [row[0] for row in connection.execute(
+					"SELECT id FROM sources WHERE video_id = ? AND cache_key IS ?", (video_id, cache_key))]
+				connection.executemany("DELETE FROM postings WHERE source = ?", [(source,) for source in stale])
+				connection.executemany("DELETE FROM sources WHERE id = ?", [(source,) for source in stale])
+				source = connection.execute(
+					"INSERT INTO sources (video_id, url, title, cache_key, start_sec, end_sec, fingerprint, added) "
+					"VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+					(video_id, url, title, cache_key, start, end, prints.tobytes(), time.time())).lastrowid
+				connection.executemany(
+					"INSERT INTO postings (hash, source, position) VALUES (?, ?, ?)",
+					[(int(value), source, position) for position, value in enumerate(prints)
+						if position % INDEX_STRIDE == 0 and 0 < value < 0xFFFFFFFF])
+		finally:
+			connection.close()
+
+	def known(self, video_id, cache_key):
+		connection = self.connect()
+
+		try:
+			return connection.execute(
+				"SELECT 1 FROM sources WHERE video_id = ? AND cache_key IS ?", (video_id, cache_key)).fetchone() is not None
+		finally:
+			connection.close()
+
+	def match(self, prints, start=0.0, exclude=None):
+		# Exact sub-fingerprint hits vote for a (source, alignment) pair through the hash index,
+		# so lookup cost grows with the hits, not with the library; only the best few are compared bit by bit
+		import numpy as np
+
+		positions = {}
+
+		for position, value in enumerate(prints):
+			if 0 < value < 0xFFFFFFFF:
+				positions.setdefault(int(value), []).append(position)
+
+		votes = Counter()
+		hashes = list(positions)
+		connection = self.connect()
+
+		try:
+			for first in range(0, len(hashes), 500):
+				batch = hashes[first:first + 500]
+				rows = connection.execute(
+					"SELECT p.hash, p.source, p.position FROM postings p JOIN sources s ON s.id = p.source "
+					f"WHERE p.hash IN ({','.join('?' * len(batch))}) AND s.video_id IS NOT ?", (*batch, exclude))
+
+				for value, source, position in rows:
+					for query_position in positions[value]:
+						votes[source, position - query_position] += 1
+
+			best = None
+
+			for (source, shift), _ in votes.most_common(CANDIDATES):
+				video_id, title, source_start, blob = connection.execute(
+					"SELECT video_id, title, start_sec, fingerprint FROM sources WHERE id = ?", (source,)).fetchone()
+				stored = np.frombuffer(blob, dtype="<u4")
+				# Overlap of the two fingerprints at this alignment
+				first_query = max(0, -shift)
+				last_query = min(len(prints), len(stored) - shift)
+
+				if last_query - first_query < MIN_OVERLAP:
+					continue
+
+				rate = bitErrorRate(prints[first_query:last_query], stored[first_query + shift:last_query + shift])
+
+				if rate <= MAX_BIT_ERROR_RATE and (best is None or rate < best['bit_error_rate']):
+					# Seconds to add to a time in the queried audio to get the same moment in the match
+					delta = source_start - start + shift * HOP_SIZE / SAMPLE_RATE
+					best = {'video_id': video_id, 'title': title, 'delta': round(delta, 3), 'bit_error_rate': float(rate)}
+		finally:
+			connection.close()
+
+		return best
+
+	def alias(self, video_id, canonical=None, delta=0.0, bit_error_rate=0.0):
+		# Records that video_id is the same recording as canonical, or looks the record up
+		connection = self.connect()
+
+		try:
+			with connection:
+				if canonical is not None:
+					connection.execute(
+						"INSERT OR REPLACE INTO aliases (video_id, canonical, delta, bit_error_rate) VALUES (?, ?, ?, ?)",
+						(video_id, canonical, delta, bit_error_rate))
+
+				row = connection.execute(
+					"SELECT canonical, delta, bit_error_rate FROM aliases WHERE video_id = ?", (video_id,)).fetchone()
+		finally:
+			connection.close()
+
+		return dict(zip(("canonical", "delta", "bit_error_rate"), row)) if row else None
+
+	def covering(self, video_id, start, end):
+		# Local sources of video_id that span start..end, widest first
+		connection = self.connect()
+
+		try:
+			rows = connection.execute(
+				"SELECT cache_key, start_sec, title FROM sources WHERE video_id = ? AND cache_key IS NOT NULL "
+				"AND start_sec <= ? AND end_sec >= ? ORDER BY end_sec - start_sec DESC", (video_id, start, end)).fetchall()
+		finally:
+			connection.close()
+
+		return [{'cache_key': cache_key, 'start': source_start, 'title': title} for cache_key, source_start, title in rows]
@@ -0,0 +1,176 @@
+import csv
+import json
+import os
+from dataclasses import dataclass
+from timestamps import TimestampError, parseWindows
+
+DEFAULT_COLUMNS = {'folder': "C", 'url': "D", 'timestamps': "E"}
+
+
+@dataclass(slots=True)
+class Task:
+	url: str
+	class_dir: str
+	folder: str
+	timestamps: str
+	source: str = ""
+	row: int = 0
+	profile: str = None  # output profile, None falls back to the run default
+	info: dict = None  # yt-dlp metadata, filled in by the resolve stage
+
+
+class SheetError(ValueError):
+
+	def __init__(self, cell, message):
+		super().__init__(f"{cell}: {message}")
+		self.cell = cell
+
+
+def cellRef(source, column, row_number):
+	# book.xlsx!E12, or book.xlsx!Sheet1!E12 when the source names its sheet
+	sheet = f"{source['sheet']}!" if 'sheet' in source else ""
+	return f"{source['path']}!{sheet}{column}{row_number}"
+
+
+def loadConfig(config_path):
+	with open(config_path, encoding="utf-8") as config_file:
+		return json.load(config_file)
+
+
+def columnIndex(letter):
+	index = 0
+
+	for char in letter.upper():
+		index = index * 26 + ord(char) - ord("A") + 1
+
+	return index - 1
+
+
+def cellValue(row, letter):
+	index = columnIndex(letter)
+	return row[index] if index < len(row) else None
+
+
+def namedRangeRows(workbook, name):
+	from openpyxl.utils.cell import range_boundaries
+
+	destinations = list(workbook.defined_names[name].destinations)
+
+	if not destinations:
+		raise ValueError(f"Named range {name} has no destination")
+
+	_, min_row, _, max_row = range_boundaries(destinations[0][1].replace("$", ""))
+	return min_row, max_row
+
+
+def resolveRoutes(routes, workbook=None):
+	resolved = []
+
+	for route in routes:
+		route = dict(route)
+
+		# Named ranges become plain row ranges before the single pass
+		if 'named_range' in route:
+			if workbook is None:
+				raise ValueError(f"Named range {route['named_range']} needs an XLSX source")
+
+			route['rows'] = namedRangeRows(workbook, route['named_range'])
+
+		resolved.append(route)
+
+	return resolved
+
+
+def routeRow(routes, row_number, row):
+	for route in routes:
+		if 'rows' in route:
+			start_row, end_row = route['rows']
+
+			if start_row <= row_number <= end_row:
+				return route['dir']
+
+		elif 'column' in route:
+			value = cellValue(row, route['column'])
+
+			if value is None or str(value).strip() == "":
+				continue
+
+			if 'equals' in route and str(value) != str(route['equals']):
+				continue
+
+			return route['dir'].format(value=value)
+
+	return None
+
+
+def readRows(source):
+	path = source['path']
+
+	if os.path.splitext(path)[1].lower() == ".csv":
+		with open(path, newline="", encoding="utf-8-sig") as csv_file:
+			routes = resolveRoutes(source['routes'])
+
+			for row_number, row in enumerate(csv.reader(csv_file, delimiter=source.get('delimiter', ",")), start=1):
+				yield routes, row_number, row
+		return
+
+	import openpyxl
+
+	# Read-only mode streams rows instead of loading every cell into memory
+	workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+
+	try:
+		worksheet = workbook[source['sheet']] if 'sheet' in source else workbook.active
+		routes = resolveRoutes(source['routes'], workbook)
+
+		for row_number, row in enumerate(worksheet.iter_rows(values_only=True), start=1):
+			yield routes, row_number, row
+	finally:
+		workbook.close()
+
+
+def readSources(config, warn=print, reject=None, output_dir=""):
+	# Rows with bad cells go to reject(task, error) instead of being downloaded
+	reject = reject or (lambda task, error: warn(f"ERROR: {error}"))
+
+	for source in config['sources']:
+		columns = {**DEFAULT_COLUMNS, **config.get('columns', {}), **source.get('columns', {})}
+
+		for routes, row_number, row in readRows(source):
+			# Header rows are skipped before routing
+			if row_number < source.get('first_row', 1):
+				continue
+
+			class_dir = routeRow(routes, row_number, row)
+
+			if class_dir is None:
+				continue
+
+			yt_url = cellValue(row, columns['url'])
+
+			if not yt_url:
+				warn(f"WARNING: Skipping empty URL in {source['path']} row {row_number}")
+				continue
+
+			# A profile column wins over the source and config defaults
+			profile = cellValue(row, columns['profile']) if 'profile' in columns else None
+			profile = str(profile).strip().lower() if profile else source.get('profile', config.get('profile'))
+
+			timestamps = cellValue(row, columns['timestamps'])
+
+			if timestamps is not None and not str(timestamps).strip():
+				timestamps = None
+
+			task = Task(
+				yt_url, os.path.join(output_dir, class_dir), cellValue(row, columns['folder']), timestamps,
+				source['path'], row_number, profile)
+
+			# Bad windows are rejected here, before any network or CPU time is spent on the row
+			if timestamps is not None:
+				try:
+					parseWindows(timestamps)
+				except TimestampError as error:
+					reject(task, SheetError(cellRef(source, columns['timestamps'], row_number), error))
+					continue
+
+			yield task
@@ -0,0 +1,205 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, replace
+from threading import Event, Lock, Thread
+from ingest import Task
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+	key TEXT PRIMARY KEY,
+	seq INTEGER,
+	task TEXT NOT NULL,
+	cost REAL,
+	state TEXT NOT NULL,
+	worker TEXT,
+	lease_until REAL,
+	leases INTEGER NOT NULL DEFAULT 0,
+	error TEXT,
+	updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until);
+"""
+
+
+class JobStore:
+
+	def __init__(self, store_path, lease_seconds=60, max_leases=3):
+		self.store_path = store_path
+		self.lease_seconds = lease_seconds
+		self.max_leases = max_leases  # a row whose lease keeps running out is failing its workers, not unlucky
+
+		connection = sqlite3.connect(store_path, timeout=60)
+
+		try:
+			connection.executescript(SCHEMA)
+		finally:
+			connection.close()
+
+	@contextmanager
+	def transaction(self):
+		# A connection per transaction, so every thread and process can use the store.
+		# The default rollback journal is used because WAL does not work on network filesystems.
+		connection = sqlite3.connect(self.store_path, timeout=60, isolation_level=None)
+
+		try:
+			connection.execute("BEGIN IMMEDIATE")
+			yield connection
+			connection.execute("COMMIT")
+		except BaseException:
+			if connection.in_transaction:
+				connection.execute("ROLLBACK")
+			raise
+		finally:
+			connection.close()
+
+	def load(self, tasks, key, cost=lambda task: None):
+		# Rows that failed in an earlier load are queued again. Rows done by any worker stay done,
+		# since workers keep their own journals and the coordinator's cannot tell; rows in flight are left alone
+		now = time.time()
+		loaded = 0
+
+		with self.transaction() as connection:
+			seq = connection.execute("SELECT COALESCE(MAX(seq), 0) FROM jobs").fetchone()[0]
+
+			for task in tasks:
+				seq += 1
+				fields = {name: value for name, value in asdict(task).items() if name != 'info'}
+				cursor = connection.execute(
+					"INSERT INTO jobs (key, seq, task, cost, state, updated) VALUES (?, ?, ?, ?, 'pending', ?) "
+					"ON CONFLICT (key) DO UPDATE SET state = 'pending', task = excluded.task, cost = excluded.cost, "
+					"leases = 0, error = NULL, updated = excluded.updated WHERE state = 'failed'",
+					(key(task), seq, json.dumps(fields, ensure_ascii=False), cost(task), now))
+				loaded += cursor.rowcount
+
+		return loaded
+
+	def lease(self, worker, count=1):
+		now = time.time()
+
+		with self.transaction() as connection:
+			connection.execute(
+				"UPDATE jobs SET state = 'failed', error = ?, updated = ? "
+				"WHERE state = 'leased' AND lease_until < ? AND leases >= ?",
+				(f"Lease expired {self.max_leases} times, its workers died or stalled", now, now, self.max_leases))
+
+			# Expired leases are taken over as if pending; unknown costs go first, like the engine orders them
+			rows = connection.execute(
+				"SELECT key, task FROM jobs WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+				"ORDER BY cost IS NULL DESC, cost DESC, seq LIMIT ?", (now, count)).fetchall()
+			connection.executemany(
+				"UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, leases = leases + 1, updated = ? "
+				"WHERE key = ?", [(worker, now + self.lease_seconds, now, key) for key, _ in rows])
+
+		return [(key, Task(**json.loads(task))) for key, task in rows]
+
+	def heartbeat(self, worker, keys):
+		# Returns the keys this worker no longer holds, because its lease ran out and another worker took them
+		now = time.time()
+
+		with self.transaction() as connection:
+			connection.executemany(
+				"UPDATE jobs SET lease_until = ?, updated = ? WHERE key = ? AND worker = ? AND state = 'leased'",
+				[(now + self.lease_seconds, now, key, worker) for key in keys])
+			held = {
+				key for key, in connection.execute(
+					"SELECT key FROM jobs WHERE worker = ? AND state = 'leased'", (worker,))}
+
+		return set(keys) - held
+
+	def finish(self, key, worker, error=None):
+		with self.transaction() as connection:
+			connection.execute(
+				"UPDATE jobs SET state = ?, error = ?, lease_until = NULL, updated = ? WHERE key = ? AND worker = ?",
+				("failed" if error else "done", error, time.time(), key, worker))
+
+	def release(self, worker, keys):
+		# Unfinished leases of a worker that shuts down go straight back instead of waiting to expire
+		with self.transaction() as connection:
+			connection.executemany(
+				"UPDATE jobs SET state = 'pending', worker = NULL, lease_until = NULL, leases = leases - 1, "
+				"updated = ? WHERE key = ? AND worker = ? AND state = 'leased'",
+				[(time.time(), key, worker) for key in keys])
+
+	def counts(self):
+		with self.transaction() as connection:
+			counts = dict(connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+		return {state: counts.get(state, 0) for state in ("pending", "leased", "done", "failed")}
+
+	def failures(self):
+		with self.transaction() as connection:
+			rows = connection.execute("SELECT task, worker, error FROM jobs WHERE state = 'failed' ORDER BY seq")
+			return [(Task(**json.loads(task)), worker, error) for task, worker, error in rows]
+
+
+class LeaseKeeper:
+
+	def __init__(self, store, worker, prefetch=10, poll=5.0, output_dir=""):
+		self.store = store
+		self.worker = worker
+		self.output_dir = output_dir  # the store keeps class folders relative, each worker puts them under its own
+		self.prefetch = prefetch  # leases held at once, so one worker cannot hoard the queue
+		self.poll = poll
+		self.lock = Lock()
+		self.held = {}  # id(task) -> key
+		self.stopped = Event()
+		self.freed = Event()  # set when a lease is finished, so the next one is taken without waiting a full poll
+		self.heartbeat = Thread(target=self.beat, daemon=True)
+		self.heartbeat.start()
+
+	def beat(self):
+		while not self.stopped.wait(self.store.lease_seconds / 3):
+			with self.lock:
+				keys = list(self.held.values())
+
+			if keys:
+				for key in self.store.heartbeat(self.worker, keys):
+					print(f"Lease lost to another worker: {key}")
+
+	def tasks(self):
+		# Blocks while this worker is full or others still hold work that may come back on timeout
+		while True:
+			self.freed.clear()
+
+			with self.lock:
+				full = len(self.held) >= self.prefetch
+
+			leased = [] if full else self.store.lease(self.worker)
+
+			for key, task in leased:
+				task = replace(task, class_dir=os.path.join(self.output_dir, task.class_dir))
+
+				with self.lock:
+					self.held[id(task)] = key
+
+				yield task
+
+			if leased:
+				continue
+
+			counts = self.store.counts()
+
+			if not counts['pending'] and not counts['leased']:
+				return
+
+			self.freed.wait(self.poll)
+
+	def finish(self, task, error=None):
+		with self.lock:
+			key = self.held.pop(id(task), None)
+
+		if key:
+			self.store.finish(key, self.worker, error)
+			self.freed.set()
+
+	def close(self):
+		self.stopped.set()
+		self.heartbeat.join()
+
+		with self.lock:
+			keys, self.held = list(self.held.values()), {}
+
+		self.store.release(self.worker, keys)
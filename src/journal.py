@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+
+STATES = ("queued", "downloading", "downloaded", "trimmed", "failed")
+
+
+def taskKey(task):
+	# Source and row are left out so moving a row in the sheet keeps its history
+	fields = (task.url, task.class_dir, task.folder, task.timestamps)
+
+	if task.profile:
+		fields += (task.profile,)
+
+	return hashlib.sha1(json.dumps([str(field) for field in fields]).encode()).hexdigest()[:16]
+
+
+class Journal:
+
+	def __init__(self, journal_path, read_only=False):
+		self.journal_path = journal_path
+		self.lock = Lock()
+		self.tasks = self.replay()
+		self.journal_file = None
+
+		# A read-only journal only replays, it never creates or touches the file
+		if read_only:
+			return
+
+		self.journal_file = open(journal_path, "a")
+
+		# Terminate a torn last line so new records start on their own line
+		if self.journal_file.tell() > 0:
+			with open(journal_path, "rb") as journal_file:
+				journal_file.seek(-1, os.SEEK_END)
+
+				if journal_file.read(1) != b"\n":
+					self.journal_file.write("\n")
+
+	def replay(self):
+		tasks = {}
+
+		try:
+			with open(self.journal_path) as journal_file:
+				for line in journal_file:
+					try:
+						record = json.loads(line)
+					except ValueError:
+						# A torn last line from a crash is ignored
+						continue
+
+					entry = tasks.setdefault(record['key'], {'attempts': 0})
+					entry.update(record)
+		except OSError:
+			pass
+
+		return tasks
+
+	def record(self, task, state, **fields):
+		if state not in STATES:
+			raise ValueError(f"Unknown task state: {state}")
+
+		key = taskKey(task)
+
+		with self.lock:
+			entry = self.tasks.setdefault(key, {'attempts': 0})
+
+			if state == "downloading":
+				entry['attempts'] += 1
+
+			entry.update(fields, key=key, state=state, time=time.time())
+			self.journal_file.write(json.dumps(dict(fields, key=key, state=state, time=entry['time'], attempts=entry['attempts'])) + "\n")
+			self.journal_file.flush()
+			os.fsync(self.journal_file.fileno())
+
+	def outputs(self, task):
+		entry = self.tasks.get(taskKey(task), {})
+
+		# Older journals record a single output
+		return entry.get('outputs') or ([entry['output']] if entry.get('output') else [])
+
+	def isDone(self, task):
+		entry = self.tasks.get(taskKey(task))
+
+		if not entry or entry['state'] not in ("downloaded", "trimmed"):
+			return False
+
+		# Only trust the journal if every output is still on disk
+		outputs = self.outputs(task)
+		return bool(outputs) and all(os.path.isfile(output) and os.path.getsize(output) > 0 for output in outputs)
+
+	def close(self):
+		if self.journal_file:
+			self.journal_file.close()
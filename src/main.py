@@ -1,20 +1,84 @@
+import argparse
+import asyncio
+import importlib.util
+import json
 import os
-import re
-import openpyxl
-import yt_dlp
-from moviepy.audio.io.AudioFileClip import AudioFileClip
-from queue import Queue
-from threading import Thread
+import socket
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from cache import DownloadCache, cacheKey, extractVideoId
+from trim import (
+	OUTPUT_PROFILES, TRIM_MODES, TrimJob, TrimService, buildFilters, outputExtension, probeMedia)
+from timestamps import parseWindows
+from engine import Engine, HostLimiter
+from journal import Journal, taskKey
+from ingest import loadConfig, readSources
+from retry import TaskFailure, classifyError
+from resolve import MetadataCache, Resolver, checkWindow
+from metrics import Metrics
+from manifest import Manifest, checkOutput
+from bandwidth import BandwidthController, parseRate
+from jobstore import JobStore, LeaseKeeper
+from fingerprint import FingerprintIndex, decodePcm, fingerprint
+from chunked import ChunkedDownload, NoRangeSupport
 
 # Globals
-A, B, C, D, E = 0, 1, 2, 3, 4
-download_queue = Queue()
+SHEET_CONFIG = "formatura.json"  # sources, columns and class folder routes
+OUTPUT_DIR = ""  # prefix for the class folders in the config, empty keeps them relative
+OUTPUT_PROFILE = "mp3"  # mp3, aac, opus, flac or "original" to remux without re-encoding
+RANGE_DOWNLOAD = True  # fetch only the timestamp window instead of the whole video
+RANGE_PAD = 2  # seconds kept around the window so the trim has room to cut
+RANGE_ALIGN = 10  # seconds, sections are rounded out to this grid so nearby windows of one video share a download
+TRIM_MODE = "copy"  # "copy" cuts sources already in the output codec on frame boundaries, "accurate" re-encodes
+NORMALIZE_LOUDNESS = False  # EBU R128 loudnorm in the same ffmpeg pass as the cut
+TARGET_LOUDNESS = -16  # LUFS
+TRIM_SILENCE = False  # drop leading and trailing silence from each clip
+FADE_SECONDS = 0  # fade in and out at the cut points, 0 disables
+CACHE_DIR = "cache"
+STAGING_DIR = os.path.join(CACHE_DIR, "staging")  # downloaded sources wait here for the transcode stage
+CACHE_MAX_BYTES = 2 * 1024 ** 3  # 2 GiB, least recently used sources are evicted first
+METADATA_DIR = os.path.join(CACHE_DIR, "metadata")
+FINGERPRINT = False  # flag rows that are another upload of a recording already downloaded, needs NumPy
+FINGERPRINT_INDEX = os.path.join(CACHE_DIR, "fingerprints.db")
+METADATA_TTL = 3 * 3600  # seconds, YouTube stream URLs expire after about 6 hours
+RESOLVE_WORKERS = 8
+MAX_DOWNLOADS = 10  # global ceiling, halved on throttling and regrown on success
+DOWNLOAD_QUEUE_SIZE = 4 * MAX_DOWNLOADS  # rows read ahead of the downloads
+HOST_RATE, HOST_BURST = 1.0, 5  # requests per second per host, only metadata and media that miss the caches count
+THROTTLE_COOLDOWN = 30  # seconds without new downloads after a 429
+BANDWIDTH_LIMIT = None  # bytes per second for all downloads together, None is unlimited
+TASK_BANDWIDTH_LIMIT = None  # bytes per second for a single download
+CHUNK_CONNECTIONS = 4  # connections per large direct download, or parallel fragments for DASH/HLS
+MAX_CHUNK_CONNECTIONS = 16  # grown towards this while each extra connection still adds throughput
+CHUNKED_MIN_BYTES = 32 * 1024 ** 2  # smaller sources finish before extra connections pay off
+STATUS_INTERVAL = 10  # seconds between live throughput and ETA lines
+SCHEDULE = "longest"  # "longest" starts the longest downloads and trims first, "sheet" keeps sheet order
+MAX_ATTEMPTS = 4  # transient failures only, permanent and local ones fail at once
+BACKOFF_BASE, BACKOFF_CAP = 2.0, 60.0  # seconds, jittered exponential backoff
+TRIM_WORKERS = os.cpu_count() or 4  # CPU-bound stage, one ffmpeg per core
+TRIM_QUEUE_SIZE = 2 * TRIM_WORKERS
+JOURNAL_PATH = "journal.jsonl"
+JOB_STORE = "jobs.db"  # SQLite job queue for coordinator and worker mode, on a volume every worker can reach
+LEASE_SECONDS = 120  # a task whose worker stops sending heartbeats for this long goes back to the queue
+MAX_LEASES = 3  # leases that may expire on one task before it is failed instead of handed out again
+MANIFEST_PATH = "manifest.jsonl"  # checksum, duration and codec of every output, one JSON line each, for verify
+VERIFY_WORKERS = os.cpu_count() or 4
+METRICS_PATH = "metrics.jsonl"  # one JSON line per stage span, queue wait and retry
+METRICS_TEXTFILE = "metrics.prom"  # Prometheus textfile export at the end of a run, None disables
+METRICS_PORT = None  # serve live Prometheus metrics on 127.0.0.1:<port> during long batches
+STAGE_WORKERS = {'resolve': RESOLVE_WORKERS, 'download': MAX_DOWNLOADS, 'transcode': TRIM_WORKERS}
+# Opened by openState() for the command that needs them
+download_cache = journal = metadata_cache = resolver = metrics = trim_service = manifest = None
+bandwidth = host_limiter = None
+fingerprints = None
 log_entries = []
+failures = []
 
 
-def writeLog():
-	log_file = "execution_log.txt"
-
+def writeLog(log_file="execution_log.txt"):
 	with open(log_file, "w") as log:
 		log.write("Execution Log\n")
 		log.write("=" * 50 + "\n")
@@ -25,119 +89,731 @@ def writeLog():
 	print(f"Log file created: {log_file}")
 
 
-def downloadAudio(yt_url, download_dir, new_folder, timestamps):
+def writeFailureReport(report_file="failures.json"):
+	summary = {}
+
+	for failure in failures:
+		summary[failure['category']] = summary.get(failure['category'], 0) + 1
+
+	with open(report_file, "w") as report:
+		json.dump({'summary': summary, 'failures': failures}, report, indent=2, ensure_ascii=False)
+
+	print(f"Failure report created: {report_file}")
+
+
+def downloadSection(timestamps):
+	# yt-dlp's ffmpeg section downloader reports no progress, so nothing could pace it against a bandwidth
+	# ceiling; with one set, the stream is fetched whole by the downloaders that report and cut locally
+	if not timestamps or not RANGE_DOWNLOAD or BANDWIDTH_LIMIT or TASK_BANDWIDTH_LIMIT:
+		return None
+
+	# One range covers every window, so all clips of a row share a single download
+	windows = parseWindows(timestamps)
+	ends = [end for _, end in windows]
+	# An open-ended window needs the rest of the video
+	last = -(-(max(ends) + RANGE_PAD) // RANGE_ALIGN) * RANGE_ALIGN if None not in ends else float("inf")
+	return (max(0, (min(start for start, _ in windows) - RANGE_PAD) // RANGE_ALIGN * RANGE_ALIGN), last)
+
+
+def windowSpan(timestamps):
+	# Source time a row needs, from its first window start to its last window end; None is the end of the video
+	windows = parseWindows(timestamps) if timestamps else [(0, None)]
+	ends = [end for _, end in windows]
+	return (min(start for start, _ in windows), max(ends) if None not in ends else None)
+
+
+def downloadKey(task):
+	# Rows of the same video wait for the one in flight; those whose windows it covers are served from the cache
+	return extractVideoId(task.url)
+
+
+def taskCost(task):
+	# Seconds of media to fetch and cut, from the resolved duration
+	duration = (task.info or {}).get('duration')
+	section = downloadSection(task.timestamps)
+
+	if section is None:
+		return duration
+
+	if section[1] == float("inf"):
+		return duration - section[0] if duration else None
+
+	return min(section[1], duration or section[1]) - section[0]
+
+
+def isChunkable(selected):
+	# A single large file over plain HTTP, merged formats and fragmented streams are left to yt-dlp
+	size = selected.get('filesize') or selected.get('filesize_approx') or 0
+	return (
+		CHUNK_CONNECTIONS > 1 and selected.get('protocol') in ("http", "https") and not selected.get('requested_formats')
+		and size >= CHUNKED_MIN_BYTES)
+
+
+def downloadChunked(selected, source_path, progress_hook):
+	download = ChunkedDownload(
+		selected['url'], source_path, selected.get('http_headers'), CHUNK_CONNECTIONS, MAX_CHUNK_CONNECTIONS,
+		progress=lambda done, total: progress_hook(
+			{'status': "downloading", 'downloaded_bytes': done, 'total_bytes': total}))
+
 	try:
-		new_folder_path = os.path.join(download_dir, str(new_folder))
-		os.makedirs(new_folder_path, exist_ok=True)
+		download.run()
+	except NoRangeSupport:
+		return None
 
-        # yt-dlp options
-		ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': os.path.join(new_folder_path, '%(title)s.%(ext)s'),
-            'postprocessors': [
-                {'key': 'FFmpegExtractAudio', 
-                'preferredcodec': 'mp3', 
-                'preferredquality': '192'}],
-		}
+	print(f"Chunked download of {os.path.getsize(source_path)} bytes over {download.connections} connections")
+	return source_path
 
-        # Download audio
-		with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-			info_dict = ydl.extract_info(yt_url, download=True)
-			mp3_file_path = ydl.prepare_filename(info_dict).replace('.webm', '.mp3').replace('.m4a', '.mp3')
 
-			if timestamps:
-				trimmed_output_path = os.path.join(new_folder_path, f"{info_dict['title']}_trim.mp3")
-				trimAudio(mp3_file_path, trimmed_output_path, timestamps)
-				os.remove(mp3_file_path)
-				log_entries.append(f"SUCCESS: Trimmed audio saved: {trimmed_output_path}")
-			else:
-				log_entries.append(f"SUCCESS: Download completed: {mp3_file_path}")
+def reusableSource(video_id, span, duration=None, link_to=None, task_id=None):
+	# A cached source of another upload of the same recording that covers this row, on this video's timeline
+	alias = fingerprints.alias(video_id) if fingerprints and video_id else None
 
-	except Exception as error:
-		log_entries.append(f"ERROR: {yt_url} - {error}")
+	if not alias:
+		return None
+
+	start, end = span
+	end = duration if end is None else end
+
+	if end is None:
+		return None
 
+	for source in fingerprints.covering(alias['canonical'], start + alias['delta'], end + alias['delta']):
+		with metrics.span("write", task_id, cached=True, reused=alias['canonical']) as span:
+			cached = download_cache.lookup(source['cache_key'], link_to)
+			span['link'] = cached and cached['link']
 
-def timestampToSeconds(timestamp):
-	match = re.match(r'(\d+):(\d+)', timestamp)
+		if cached:
+			return dict(source, **alias, path=cached['path'])
+
+	return None
+
+
+def identifySource(video_id, yt_url, title, source_path, start, cache_key, task_id=None):
+	# Sources already in the index, such as cache hits, are not decoded again
+	if fingerprints.known(video_id, cache_key):
+		return
+
+	try:
+		with metrics.span("fingerprint", task_id):
+			prints = fingerprint(decodePcm(source_path))
+			match = fingerprints.match(prints, start, exclude=video_id)
+
+			if match:
+				fingerprints.alias(video_id, match['video_id'], match['delta'], match['bit_error_rate'])
+
+			fingerprints.add(video_id, prints, start, yt_url, title, cache_key)
+	except Exception as error:
+		# Deduplication is best effort, the row itself goes on
+		log_entries.append(f"WARNING: Fingerprint of {yt_url} failed: {error}")
+		return
 
 	if match:
-		minutes, seconds = map(int, match.groups())
-		return minutes * 60 + seconds
+		log_entries.append(
+			f"DUPLICATE: {yt_url} ({title}) is the same recording as {match['video_id']} ({match['title']}), "
+			f"offset {match['delta']:+.1f}s, bit error rate {match['bit_error_rate']:.2f}")
 
-	return 0
 
+def downloadAudio(yt_url, download_dir, new_folder, timestamps, info=None, profile=OUTPUT_PROFILE, task_id=None):
+	# yt-dlp takes a while to import, so only the commands that download pay for it
+	import yt_dlp
+	from yt_dlp.utils import download_range_func, sanitize_filename
 
-def trimAudio(file_path, output_path, timestamps):
-	audio = AudioFileClip(file_path)
-	start, end = re.findall(r'\d+:\d+', timestamps)
-	start_sec = timestampToSeconds(start)
-	end_sec = min(timestampToSeconds(end), audio.duration)
-    
-	trimmed_audio = audio.subclipped(start_sec, end_sec)
-	trimmed_audio.write_audiofile(output_path, codec="libmp3lame")
+	new_folder_path = os.path.join(download_dir, str(new_folder))
+	os.makedirs(new_folder_path, exist_ok=True)
+	os.makedirs(STAGING_DIR, exist_ok=True)
 
-	trimmed_audio.close()
-	audio.close()
+	windows = parseWindows(timestamps) if timestamps else [(None, None)]
+	section = downloadSection(timestamps)
 
+	# The source container is cached as downloaded, before any transcoding
+	video_id = extractVideoId(yt_url)
+	cache_key = cacheKey(video_id, "bestaudio", "source", section) if video_id else None
+	staging_name = f"{video_id or 'source'}-{uuid.uuid4().hex[:8]}"
+	cached = reused = probed = None
 
-def processQueue():
-	while True:
-		task = download_queue.get()
+	# Any cached download of this video that covers every window will do, whatever range it was made for.
+	# The index in memory is only a hint, the lookup under the cache lock decides; a miss there downloads.
+	for key in download_cache.covering(video_id, *windowSpan(timestamps)) if video_id else []:
+		with metrics.span("write", task_id, cached=True) as span:
+			cached = download_cache.lookup(key, os.path.join(STAGING_DIR, staging_name))
+			span['link'] = cached and cached['link']
 
-		if task is None:
+		if cached:
 			break
 
-		yt_url, download_dir, new_folder, timestamps = task
-		print(f"Processing task: {yt_url} in {new_folder}")
+	if not cached:
+		reused = reusableSource(
+			video_id, windowSpan(timestamps), (info or {}).get('duration'), os.path.join(STAGING_DIR, staging_name),
+			task_id)
+
+	if cached:
+		# Serve repeated rows and reruns from the cache
+		title = cached['title']
+		source_path = cached['path']
+		offset = cached['start']
+	elif reused:
+		# Another upload of the same recording is already local, so nothing is downloaded
+		title = (info or {}).get('title') or reused['title']
+		source_path = reused['path']
+		offset = reused['start'] - reused['delta']
+		log_entries.append(
+			f"REUSED: {yt_url} served from {reused['canonical']}, the same recording ({reused['delta']:+.1f}s)")
+	else:
+		# Only now does the row go to the network, cache and reuse hits never wait for the host's rate limit
+		host_limiter.acquire(yt_url)
+		# yt-dlp options
+		ydl_opts = {
+			'format': 'bestaudio/best',
+			'outtmpl': os.path.join(STAGING_DIR, f'{staging_name}.%(ext)s'),
+		}
 
-		downloadAudio(yt_url, download_dir, new_folder, timestamps)
-		download_queue.task_done()
+		if section:
+			# Only the segments covering the padded window are fetched. ffmpeg starts its stream copy at the
+			# keyframe before the section, so the source timestamps are kept to measure where the file really starts.
+			ydl_opts['download_ranges'] = download_range_func(None, [section])
+			ydl_opts['external_downloader_args'] = {'ffmpeg_o': ["-copyts"]}
 
+		if CHUNK_CONNECTIONS > 1:
+			# DASH and HLS streams fetch this many fragments at once
+			ydl_opts['concurrent_fragment_downloads'] = CHUNK_CONNECTIONS
 
-def enqueueTasks(class_dir, worksheet, start_row, end_row):
-	for row in worksheet.iter_rows(min_row=start_row, max_row=end_row, values_only=True):
-		new_folder = row[C]
-		yt_url = row[D]
-		timestamps = row[E]
+		# Download audio, paced by the shared bandwidth budget through the progress hook
+		with bandwidth.track(task_id or staging_name) as progress_hook:
+			ydl_opts['progress_hooks'] = [progress_hook]
 
-		if yt_url:
-			download_queue.put((yt_url, class_dir, new_folder, timestamps))
-		else:
-			log_entries.append(f"WARNING: Skipping empty URL in row {row[A]}")
+			with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+				if info:
+					# Metadata from the resolve stage skips the page fetch and extraction
+					selected = ydl.process_ie_result(info, download=False)
+				else:
+					selected = ydl.extract_info(yt_url, download=False)
+
+				title = selected['title']
+				source_path = None
+
+				if not section and isChunkable(selected):
+					source_path = os.path.join(STAGING_DIR, f"{staging_name}.{selected['ext']}")
+					source_path = downloadChunked(selected, source_path, progress_hook)
+
+				if not source_path:
+					info_dict = ydl.process_ie_result(selected, download=True)
+					# yt-dlp reports where the file really ended up
+					source_path = info_dict['requested_downloads'][0]['filepath']
+
+		probed = probeMedia(source_path)
+		# A full download starts at 0:00 whatever its container says, a section where its first kept timestamp is
+		offset = probed['start'] if section else 0
+		# yt-dlp drops a section end past the video, and the download then runs to the end
+		reaches_end = not section or section[1] >= (selected.get('duration') or float("inf"))
+
+		if cache_key:
+			with metrics.span("write", task_id, cached=False, bytes=os.path.getsize(source_path)):
+				download_cache.store(
+					cache_key, source_path, title=title, video_id=video_id, start=offset,
+					end=None if reaches_end else section[1])
+
+	# Fingerprinting is CPU work, so it runs in the transcode stage and does not hold a download slot
+	fingerprint_key = cache_key if fingerprints and video_id and not reused else None
+	source_codec = (probed or probeMedia(source_path))['codec']
+	ext = outputExtension(profile, source_codec)
 
+	if timestamps:
+		suffixes = ["_trim"] if len(windows) == 1 else [f"_trim{i}" for i in range(1, len(windows) + 1)]
+		# Titles such as "AC/DC - ..." would otherwise name a subdirectory
+		output_paths = [os.path.join(new_folder_path, f"{sanitize_filename(title)}{suffix}.{ext}") for suffix in suffixes]
+		windows = [(start - offset, end - offset if end is not None else None) for start, end in windows]
+		return (source_path, output_paths, windows, profile, source_codec, offset, title, fingerprint_key)
 
-def main():
-	download_dirs = ["musicas/3001", "musicas/3002", "musicas/3003"]
-	start_rows = [2, 40, 74]
-	end_rows = [38, 72, 104]
+	output_path = os.path.join(new_folder_path, f"{sanitize_filename(title)}.{ext}")
+	return (source_path, [output_path], windows, profile, source_codec, offset, title, fingerprint_key)
 
-	workbook = openpyxl.load_workbook("yt-dl-formatura.xlsx")
-	worksheet = workbook.active
 
-    # Start the worker threads
-	worker_threads = []
-    
-	for _ in range(10):  # Adjust the number of threads as needed
-		worker = Thread(target=processQueue)
-		worker.start()
-		worker_threads.append(worker)
+def checkTask(task, info=None):
+	if task.profile and task.profile not in OUTPUT_PROFILES:
+		raise ValueError(f"Unknown output profile: {task.profile}")
+
+	# Without metadata only the window itself can be checked, not the video duration
+	if task.timestamps:
+		checkWindow(info or {}, task.timestamps)
+
+
+def resolveTask(task):
+	checkTask(task)
+
+	with metrics.span("resolve", taskKey(task)):
+		task.info = resolver.resolve(task.url, extractVideoId(task.url))
+		checkTask(task, task.info)
+
+	return task
+
+
+def runTask(task):
+	print(f"Processing task: {task.url} in {task.folder}")
+	journal.record(task, "downloading")
+	task_id = taskKey(task)
+
+	try:
+		with metrics.span("download", task_id, attempt=journal.tasks[task_id]['attempts']) as span:
+			result = downloadAudio(
+				task.url, task.class_dir, task.folder, task.timestamps, task.info, task.profile or OUTPUT_PROFILE,
+				task_id)
+			span['bytes'] = os.path.getsize(result[0])
+	except Exception:
+		# The cached stream URL may have expired, so a retry extracts afresh
+		if task.info:
+			metadata_cache.drop(task.info['id'])
+			task.info = None
+		raise
+
+	journal.record(task, "downloaded")
+	return TrimJob(task, *result)
+
+
+def expectedDurations(job):
+	# Silence trimming makes clip lengths unpredictable, and without metadata full-length outputs are too
+	if TRIM_SILENCE:
+		return [None] * len(job.windows)
+
+	duration = (job.task.info or {}).get('duration')
+
+	if not job.task.timestamps:
+		return [duration]
+
+	expected = []
+
+	for start_sec, end_sec in parseWindows(job.task.timestamps):
+		if duration:
+			end_sec = min(end_sec, duration) if end_sec is not None else duration
+
+		expected.append(end_sec - start_sec if end_sec is not None else None)
+
+	return expected
+
+
+def transcodeJob(job):
+	filters = None
+
+	if NORMALIZE_LOUDNESS or TRIM_SILENCE or FADE_SECONDS:
+		filters = buildFilters(NORMALIZE_LOUDNESS, TARGET_LOUDNESS, TRIM_SILENCE, FADE_SECONDS)
+
+	try:
+		if job.fingerprint_key:
+			identifySource(
+				extractVideoId(job.task.url), job.task.url, job.title, job.source_path, job.source_start, job.fingerprint_key,
+				taskKey(job.task))
+
+		with metrics.span("transcode", taskKey(job.task), bytes=os.path.getsize(job.source_path)) as span:
+			# The trim thread only waits, ffmpeg is driven from the trim service's worker processes
+			trim_service.submit(job, TRIM_MODE, filters).result()
+			span['output_size'] = sum(os.path.getsize(output_path) for output_path in job.output_paths)
+	finally:
+		os.remove(job.source_path)
+
+	for output_path, expected_duration in zip(job.output_paths, expectedDurations(job)):
+		manifest.add(output_path, taskKey(job.task), expected_duration)
+
+	journal.record(job.task, "trimmed", outputs=job.output_paths)
+
+	for output_path in job.output_paths:
+		if job.windows[0][0] is not None:
+			log_entries.append(f"SUCCESS: Trimmed audio saved: {output_path}")
+		else:
+			log_entries.append(f"SUCCESS: Download completed: {output_path}")
+
+
+def logError(task, error):
+	if not isinstance(error, TaskFailure):
+		error = TaskFailure(error, classifyError(error), 1)
+
+	journal.record(task, "failed", error=str(error), category=error.category)
+	log_entries.append(f"ERROR: {task.url} - {error.category} after {error.attempts} attempt(s) - {error}")
+	failures.append({
+		'url': task.url, 'download_dir': task.class_dir, 'folder': str(task.folder), 'timestamps': str(task.timestamps or ""),
+		'source': task.source, 'row': task.row,
+		'category': error.category, 'attempts': error.attempts, 'error': str(error),
+	})
+
+
+def logStageStats(stage_stats, elapsed):
+	log_entries.append(f"STATS: {elapsed:.1f}s total")
+	log_entries.append(
+		f"STATS: download stage - up to {MAX_DOWNLOADS} downloads (ended at {stage_stats['final_limit']}), "
+		f"{stage_stats['throttled']} throttled, {stage_stats['retries']} retried, "
+		f"{stage_stats['download_blocked']:.1f}s blocked on a full trim queue")
+	log_entries.append(
+		f"STATS: scheduling - {SCHEDULE} first, {stage_stats['coalesced']} rows coalesced into in-flight downloads, "
+		f"download makespan {stage_stats['makespan_sheet_order']:.1f}s in sheet order vs "
+		f"{stage_stats['makespan_longest_first']:.1f}s longest first")
+	log_entries.append(
+		f"STATS: trim stage - {TRIM_WORKERS} workers, "
+		f"{stage_stats['trim_idle']:.1f}s idle waiting for downloads, "
+		f"queue peak {stage_stats['trim_queue_peak']}/{TRIM_QUEUE_SIZE}")
+
+
+def logMetricsSummary(summary):
+	for stage, values in summary['stages'].items():
+		log_entries.append(
+			f"STATS: {stage} - {values['count']} spans, p50 {values['p50']}s, p95 {values['p95']}s, max {values['max']}s, "
+			f"queue wait p95 {values['wait_p95']}s, {values['retries']} retries, "
+			f"utilisation {values.get('utilisation', 0):.0%}")
+
+
+def sheetTasks(warn=print, reject=None):
+	return readSources(loadConfig(SHEET_CONFIG), warn, reject, OUTPUT_DIR)
+
+
+def outputProblems(task):
+	# What verify would report for a finished row's outputs, checked against their manifest entries
+	outputs = manifest.outputsFor(taskKey(task)) or journal.outputs(task)
+	problems = [(output_path, checkOutput(output_path, manifest.entries.get(output_path))) for output_path in outputs]
+	return [(output_path, problem) for output_path, problem in problems if problem]
+
+
+def pendingTasks():
+	# Rows rejected at ingest go straight to the failure report
+	for task in sheetTasks(log_entries.append, logError):
+		# Rerun only rows that are unfinished, failed or whose outputs no longer check out
+		if journal.isDone(task):
+			problems = outputProblems(task)
+
+			if not problems:
+				log_entries.append(f"SKIP: Already done: {task.url} in {task.folder}")
+				continue
+
+			for output_path, problem in problems:
+				log_entries.append(f"RERUN: {problem}: {output_path}")
+
+		journal.record(task, "queued")
+		yield task
+
+
+def openState():
+	global download_cache, journal, metadata_cache, resolver, metrics, trim_service, manifest
+	global bandwidth, fingerprints, host_limiter
+
+	download_cache = DownloadCache(CACHE_DIR, CACHE_MAX_BYTES)
+	journal = Journal(JOURNAL_PATH)
+	metadata_cache = MetadataCache(METADATA_DIR, METADATA_TTL)
+	host_limiter = HostLimiter(HOST_RATE, HOST_BURST)
+	resolver = Resolver(metadata_cache, limiter=host_limiter)
+	metrics = Metrics(METRICS_PATH)
+	trim_service = TrimService(TRIM_WORKERS)
+	manifest = Manifest(MANIFEST_PATH)
+	bandwidth = BandwidthController(BANDWIDTH_LIMIT, TASK_BANDWIDTH_LIMIT, STATUS_INTERVAL)
+	metrics.live = bandwidth.status
+
+	if RANGE_DOWNLOAD and (BANDWIDTH_LIMIT or TASK_BANDWIDTH_LIMIT):
+		print("Bandwidth ceiling set: whole streams are downloaded so every byte is metered, windows are cut locally")
+
+	if FINGERPRINT:
+		# NumPy is only needed, and only imported, when fingerprinting is on
+		if importlib.util.find_spec("numpy") is None:
+			raise SystemExit("Fingerprinting needs NumPy: pip install numpy")
+
+		fingerprints = FingerprintIndex(FINGERPRINT_INDEX)
+
+
+def runTasks(tasks, trim=transcodeJob, on_error=logError):
+	engine = Engine(
+		runTask, trim, on_error, resolve=resolveTask, resolve_workers=RESOLVE_WORKERS,
+		max_downloads=MAX_DOWNLOADS, throttle_cooldown=THROTTLE_COOLDOWN,
+		max_attempts=MAX_ATTEMPTS, backoff_base=BACKOFF_BASE, backoff_cap=BACKOFF_CAP,
+		trim_workers=TRIM_WORKERS, trim_queue_size=TRIM_QUEUE_SIZE, queue_size=DOWNLOAD_QUEUE_SIZE,
+		metrics=metrics, task_id=taskKey, task_cost=taskCost if SCHEDULE == "longest" else None,
+		download_key=downloadKey)
+
+	if METRICS_PORT:
+		metrics.serve(METRICS_PORT, STAGE_WORKERS)
+
+	started = time.monotonic()
+	try:
+		asyncio.run(engine.run(tasks))
+	finally:
+		trim_service.close()
 
-    # Enqueue tasks
-	for i in range(len(download_dirs)):
-		enqueueTasks(download_dirs[i], worksheet, start_rows[i], end_rows[i])
+	logStageStats(engine.stats, time.monotonic() - started)
 
-    # Signal end of queue
-	for _ in worker_threads:
-		download_queue.put(None)
+	if METRICS_TEXTFILE:
+		metrics.writeTextfile(METRICS_TEXTFILE, STAGE_WORKERS)
 
-    # Wait for all threads to finish
-	for worker in worker_threads:
-		worker.join()
+	logMetricsSummary(metrics.close(STAGE_WORKERS))
+	journal.close()
+	manifest.close()
+
+
+def runCommand(args):
+	openState()
+	runTasks(pendingTasks())
 
     # Write the log file
 	writeLog()
+	writeFailureReport()
+	return 1 if failures else 0
+
+
+def coordinatorCommand(args):
+	global journal, manifest
+
+	journal = Journal(JOURNAL_PATH)
+	manifest = Manifest(MANIFEST_PATH)
+	store = JobStore(JOB_STORE, LEASE_SECONDS, MAX_LEASES)
+	# Rows rejected at ingest or already done never reach the store, the rest is ordered like a local run.
+	# Class folders are stored relative to --output-dir, every worker puts them under its own.
+	tasks = (replace(task, class_dir=os.path.relpath(task.class_dir, OUTPUT_DIR or ".")) for task in pendingTasks())
+	loaded = store.load(tasks, taskKey, taskCost if SCHEDULE == "longest" else lambda task: None)
+	journal.close()
+	print(f"{loaded} rows queued in {JOB_STORE}")
+	writeLog()
+	writeFailureReport()
 
+	while True:
+		counts = store.counts()
+		print(
+			f"Jobs: {counts['pending']} pending, {counts['leased']} leased, "
+			f"{counts['done']} done, {counts['failed']} failed")
 
-if __name__ == "__main__":
-	main()
+		if not args.wait or not counts['pending'] and not counts['leased']:
+			break
+
+		time.sleep(STATUS_INTERVAL)
+
+	if not args.wait:
+		return 1 if failures else 0
+
+	failed = store.failures()
+
+	for task, worker, error in failed:
+		print(f"FAILED: {task.source} row {task.row}: {task.url} in {task.folder} on {worker} - {error}")
+
+	return 1 if failures or failed else 0
+
+
+def workerCommand(args):
+	global METRICS_TEXTFILE
+
+	# Several workers may share a host and a working directory, so their reports are named after them
+	worker_id = f"{socket.gethostname()}-{os.getpid()}"
+	openState()
+	keeper = LeaseKeeper(
+		JobStore(JOB_STORE, LEASE_SECONDS, MAX_LEASES), worker_id, prefetch=MAX_DOWNLOADS, output_dir=OUTPUT_DIR)
+
+	if METRICS_TEXTFILE:
+		METRICS_TEXTFILE = f"{os.path.splitext(METRICS_TEXTFILE)[0]}.{worker_id}.prom"
+
+	def trim(job):
+		transcodeJob(job)
+		keeper.finish(job.task)
+
+	def onError(task, error):
+		logError(task, error)
+		keeper.finish(task, str(error))
+
+	print(f"Worker {worker_id} leasing from {JOB_STORE}")
+
+	try:
+		runTasks(keeper.tasks(), trim, onError)
+	finally:
+		# Leases still held go back to the queue at once, for example after Ctrl-C
+		keeper.close()
+
+	writeLog(f"execution_log.{worker_id}.txt")
+	writeFailureReport(f"failures.{worker_id}.json")
+	return 1 if failures else 0
+
+
+def resolveCommand(args):
+	global metadata_cache, resolver
+
+	rejected = []
+	tasks = list(sheetTasks(reject=lambda task, error: rejected.append(f"ERROR: {error}")))
+
+	if not args.offline:
+		metadata_cache = MetadataCache(METADATA_DIR, METADATA_TTL)
+		resolver = Resolver(metadata_cache, limiter=HostLimiter(HOST_RATE, HOST_BURST))
+
+	def check(task):
+		try:
+			if args.offline:
+				checkTask(task)
+			else:
+				checkTask(task, resolver.resolve(task.url, extractVideoId(task.url)))
+		except Exception as error:
+			return f"ERROR: {task.source} row {task.row}: {error}"
+
+		return None
+
+	with ThreadPoolExecutor(1 if args.offline else RESOLVE_WORKERS) as executor:
+		errors = rejected + [error for error in executor.map(check, tasks) if error]
+
+	for error in errors:
+		print(error)
+
+	print(f"{len(tasks) + len(rejected)} rows checked, {len(errors)} with errors")
+	return 1 if errors else 0
+
+
+def verifyCommand(args):
+	global journal
+
+	# Only the replayed journal state is needed, nothing is written
+	journal = Journal(JOURNAL_PATH, read_only=True)
+	output_manifest = Manifest(MANIFEST_PATH)
+	problems = []
+	checks = []
+	rows = 0
+
+	for task in sheetTasks():
+		rows += 1
+		outputs = output_manifest.outputsFor(taskKey(task)) or journal.outputs(task)
+
+		if not outputs:
+			state = journal.tasks.get(taskKey(task), {}).get('state', "never run")
+			problems.append(f"MISSING: {task.source} row {task.row}: {task.url} in {task.folder} ({state})")
+
+		checks += [(task, output_path) for output_path in outputs]
+
+	def check(item):
+		task, output_path = item
+		problem = checkOutput(output_path, output_manifest.entries.get(output_path))
+		return f"{problem}: {task.source} row {task.row}: {output_path}" if problem else None
+
+	# ffprobe and the checksums run in parallel, one per core
+	with ThreadPoolExecutor(VERIFY_WORKERS) as executor:
+		problems += [problem for problem in executor.map(check, checks) if problem]
 
+	for problem in problems:
+		print(problem)
+
+	print(f"{rows} rows, {len(checks)} outputs checked, {len(problems)} problems")
+	return 1 if problems else 0
+
+
+def benchCommand(args):
+	import bench
+
+	return bench.main(args.bench_args)
+
+
+def parseArgs(argv=None):
+	parser = argparse.ArgumentParser(prog="yt-audio-dl", description="Download and trim the audio clips listed in a sheet")
+	commands = parser.add_subparsers(dest="command", required=True)
+
+	run = commands.add_parser("run", help="download and trim every pending row")
+	resolve = commands.add_parser("resolve", help="check the sheet and resolve metadata without downloading")
+	verify = commands.add_parser("verify", help="check every output against the sheet and the manifest")
+	coordinator = commands.add_parser("coordinator", help="load the pending rows into a job store shared by workers")
+	worker = commands.add_parser("worker", help="download and trim rows leased from a shared job store")
+	commands.add_parser("bench", help="offline benchmark, see bench --help", add_help=False)
+
+	for command in (run, resolve, verify, coordinator, worker):
+		command.add_argument("--config", default=SHEET_CONFIG, help="sheet config (default: %(default)s)")
+		command.add_argument("--output-dir", default=OUTPUT_DIR, help="prefix for the class folders")
+		command.add_argument("--journal", default=JOURNAL_PATH, help="journal file (default: %(default)s)")
+
+	for command in (run, resolve, worker):
+		command.add_argument("--cache-dir", default=CACHE_DIR, help="cache directory (default: %(default)s)")
+		command.add_argument("--resolve-workers", type=int, default=RESOLVE_WORKERS)
+		command.add_argument(
+			"--host-rate", type=float, default=HOST_RATE, help="requests per second per host (default: %(default)s)")
+
+	for command in (run, worker):
+		command.add_argument("--profile", choices=sorted(OUTPUT_PROFILES), default=OUTPUT_PROFILE)
+		command.add_argument("--trim-mode", choices=TRIM_MODES, default=TRIM_MODE)
+		command.add_argument(
+			"--downloads", type=int, default=MAX_DOWNLOADS, help="concurrent downloads (default: %(default)s)")
+		command.add_argument(
+			"--connections", type=int, default=CHUNK_CONNECTIONS, help="connections per large download, 1 disables")
+		command.add_argument("--trim-workers", type=int, default=TRIM_WORKERS, help="concurrent ffmpeg processes")
+		command.add_argument(
+			"--normalize", action="store_true", default=NORMALIZE_LOUDNESS, help="EBU R128 loudness normalization")
+		command.add_argument("--trim-silence", action="store_true", default=TRIM_SILENCE)
+		command.add_argument("--fade", type=float, default=FADE_SECONDS, help="fade in and out, in seconds")
+		command.add_argument(
+			"--bandwidth", type=parseRate, default=BANDWIDTH_LIMIT, help="ceiling for all downloads, e.g. 2M")
+		command.add_argument("--task-bandwidth", type=parseRate, default=TASK_BANDWIDTH_LIMIT, help="ceiling per download")
+		command.add_argument("--metrics-port", type=int, default=METRICS_PORT)
+		command.add_argument(
+			"--fingerprint", action="store_true", default=FINGERPRINT,
+			help="flag and reuse other uploads of recordings already downloaded (needs NumPy)")
+
+	for command in (run, worker, coordinator):
+		command.add_argument("--schedule", choices=("longest", "sheet"), default=SCHEDULE, help="download and trim order")
+
+	for command in (worker, coordinator):
+		command.add_argument("--store", default=JOB_STORE, help="shared job store (default: %(default)s)")
+
+	worker.add_argument("--lease", type=float, default=LEASE_SECONDS, help="seconds a task is held without a heartbeat")
+	coordinator.add_argument("--wait", action="store_true", help="follow progress until every job is done or failed")
+	resolve.add_argument("--offline", action="store_true", help="only check the sheet, without network access")
+	verify.add_argument("--workers", type=int, default=VERIFY_WORKERS, help="parallel ffprobe checks")
+
+	for command in (run, verify, worker, coordinator):
+		command.add_argument("--manifest", default=MANIFEST_PATH, help="output manifest (default: %(default)s)")
+
+	# Everything after "bench" belongs to bench.py
+	args, extra = parser.parse_known_args(argv)
+
+	if args.command == "bench":
+		args.bench_args = extra
+	elif extra:
+		parser.error(f"unrecognized arguments: {' '.join(extra)}")
+
+	return args
+
+
+def configure(args):
+	global SHEET_CONFIG, OUTPUT_DIR, JOURNAL_PATH, CACHE_DIR, STAGING_DIR, METADATA_DIR, RESOLVE_WORKERS
+	global OUTPUT_PROFILE, TRIM_MODE, MAX_DOWNLOADS, DOWNLOAD_QUEUE_SIZE, TRIM_WORKERS, TRIM_QUEUE_SIZE
+	global NORMALIZE_LOUDNESS, TRIM_SILENCE, FADE_SECONDS, METRICS_PORT, MANIFEST_PATH, VERIFY_WORKERS, SCHEDULE
+	global BANDWIDTH_LIMIT, TASK_BANDWIDTH_LIMIT, CHUNK_CONNECTIONS, JOB_STORE, LEASE_SECONDS, FINGERPRINT
+	global FINGERPRINT_INDEX, HOST_RATE
+
+	SHEET_CONFIG, OUTPUT_DIR, JOURNAL_PATH = args.config, args.output_dir, args.journal
+
+	if args.command in ("run", "resolve", "worker"):
+		CACHE_DIR, RESOLVE_WORKERS, HOST_RATE = args.cache_dir, args.resolve_workers, args.host_rate
+		STAGING_DIR = os.path.join(CACHE_DIR, "staging")
+		METADATA_DIR = os.path.join(CACHE_DIR, "metadata")
+		FINGERPRINT_INDEX = os.path.join(CACHE_DIR, "fingerprints.db")
+
+	if args.command in ("run", "verify", "worker", "coordinator"):
+		MANIFEST_PATH = args.manifest
+
+	if args.command == "verify":
+		VERIFY_WORKERS = args.workers
+
+	if args.command in ("worker", "coordinator"):
+		JOB_STORE, SCHEDULE = args.store, args.schedule
+
+	if args.command == "worker":
+		LEASE_SECONDS = args.lease
+
+	if args.command in ("run", "worker"):
+		OUTPUT_PROFILE, TRIM_MODE, SCHEDULE = args.profile, args.trim_mode, args.schedule
+		MAX_DOWNLOADS, DOWNLOAD_QUEUE_SIZE = args.downloads, 4 * args.downloads
+		TRIM_WORKERS, TRIM_QUEUE_SIZE = args.trim_workers, 2 * args.trim_workers
+		NORMALIZE_LOUDNESS, TRIM_SILENCE, FADE_SECONDS = args.normalize, args.trim_silence, args.fade
+		METRICS_PORT = args.metrics_port
+		BANDWIDTH_LIMIT, TASK_BANDWIDTH_LIMIT = args.bandwidth, args.task_bandwidth
+		CHUNK_CONNECTIONS = args.connections
+		FINGERPRINT = args.fingerprint
+
+	STAGE_WORKERS.update(resolve=RESOLVE_WORKERS, download=MAX_DOWNLOADS, transcode=TRIM_WORKERS)
+
+
+COMMANDS = {
+	'run': runCommand, 'resolve': resolveCommand, 'verify': verifyCommand, 'coordinator': coordinatorCommand,
+	'worker': workerCommand, 'bench': benchCommand}
+
+
+def main(argv=None):
+	args = parseArgs(argv)
+
+	if args.command != "bench":
+		configure(args)
+
+	return COMMANDS[args.command](args)
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+from cache import fileLock
+from trim import probeMedia
+
+DURATION_TOLERANCE = 0.5  # seconds, covers codec frame boundaries and encoder padding
+
+
+def fileChecksum(file_path):
+	digest = hashlib.sha256()
+
+	with open(file_path, "rb") as checked_file:
+		for block in iter(lambda: checked_file.read(1024 * 1024), b""):
+			digest.update(block)
+
+	return digest.hexdigest()
+
+
+class Manifest:
+
+	def __init__(self, manifest_path):
+		self.manifest_path = manifest_path
+		self.lock = Lock()
+		self.entries = {}
+		self.by_task = {}
+		self.manifest_file = None  # opened on the first add, so verify never writes
+
+		for output_path, entry in self.read():
+			self.remember(output_path, entry)
+
+	def read(self):
+		# One JSON record per output; a later record for the same output replaces the earlier one
+		try:
+			with open(self.manifest_path, encoding="utf-8") as manifest_file:
+				for line in manifest_file:
+					try:
+						record = json.loads(line)
+					except ValueError:
+						# A torn last line from a crash is ignored
+						continue
+
+					yield record.pop('output'), record
+		except OSError:
+			return
+
+	def remember(self, output_path, entry):
+		previous = self.entries.get(output_path)
+
+		if previous and output_path in self.by_task.get(previous['task'], []):
+			self.by_task[previous['task']].remove(output_path)
+
+		self.entries[output_path] = entry
+		self.by_task.setdefault(entry['task'], []).append(output_path)
+
+	def open(self):
+		self.manifest_file = open(self.manifest_path, "a", encoding="utf-8")
+
+		# Terminate a torn last line so new records start on their own line
+		if self.manifest_file.tell() > 0:
+			with open(self.manifest_path, "rb") as manifest_file:
+				manifest_file.seek(-1, os.SEEK_END)
+
+				if manifest_file.read(1) != b"\n":
+					self.manifest_file.write("\n")
+
+	def add(self, output_path, task_id, expected_duration=None):
+		# Probing a file that was just written also catches outputs ffmpeg left unreadable
+		probed = probeMedia(output_path)
+		entry = {
+			'task': task_id,
+			'sha256': fileChecksum(output_path),
+			'size': os.path.getsize(output_path),
+			'codec': probed['codec'],
+			'duration': probed['duration'],
+			'expected_duration': expected_duration,
+			'time': time.time(),
+		}
+
+		with self.lock:
+			self.remember(output_path, entry)
+
+			if self.manifest_file is None:
+				self.open()
+
+			# Appended like the journal; the lock keeps lines from workers on a shared volume whole
+			with fileLock(self.manifest_path + ".lock"):
+				self.manifest_file.write(json.dumps(dict(entry, output=output_path), ensure_ascii=False) + "\n")
+				self.manifest_file.flush()
+
+		return entry
+
+	def outputsFor(self, task_id):
+		with self.lock:
+			return list(self.by_task.get(task_id, []))
+
+	def close(self):
+		if self.manifest_file:
+			self.manifest_file.close()
+
+
+def checkOutput(output_path, entry=None, tolerance=DURATION_TOLERANCE):
+	# Returns what is wrong with an output, or None. Only headers are probed, nothing is decoded.
+	if not os.path.isfile(output_path) or os.path.getsize(output_path) == 0:
+		return "MISSING"
+
+	try:
+		probed = probeMedia(output_path)
+	except RuntimeError as error:
+		return f"CORRUPT ({error})"
+
+	if entry is None:
+		# Written before the manifest existed, a readable header is all that can be checked
+		return None
+
+	if os.path.getsize(output_path) != entry['size'] or fileChecksum(output_path) != entry['sha256']:
+		return "CORRUPT (checksum mismatch)"
+
+	expected = entry['expected_duration'] or entry['duration']
+
+	if expected and (probed['duration'] is None or abs(probed['duration'] - expected) > tolerance):
+		return f"WRONG DURATION ({probed['duration']}s, expected {expected}s)"
+
+	return None
@@ -0,0 +1,159 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+
+def percentile(values, fraction):
+	if not values:
+		return 0.0
+
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Metrics:
+
+	def __init__(self, metrics_path):
+		self.metrics_path = metrics_path
+		self.lock = Lock()
+		self.spans = {}
+		self.waits = {}
+		self.bytes = {}
+		self.retries = {}
+		self.started = time.monotonic()
+		self.live = None  # optional callable returning live download status for the Prometheus export
+		self.metrics_file = open(metrics_path, "a")
+
+	def emit(self, record):
+		with self.lock:
+			self.metrics_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+			self.metrics_file.flush()
+
+	@contextmanager
+	def span(self, stage, task_id, **fields):
+		# Callers add bytes, output size and so on to the yielded dict
+		record = dict(fields, type="span", stage=stage, task=task_id)
+		started = time.monotonic()
+
+		try:
+			yield record
+		except Exception as error:
+			record['error'] = str(error)
+			raise
+		finally:
+			record['wall'] = round(time.monotonic() - started, 4)
+
+			if record.get('bytes') and record['wall'] > 0:
+				record['throughput'] = round(record['bytes'] / record['wall'])
+
+			with self.lock:
+				self.spans.setdefault(stage, []).append(record['wall'])
+				self.bytes[stage] = self.bytes.get(stage, 0) + record.get('bytes', 0)
+
+			self.emit(dict(record, time=time.time()))
+
+	def queueWait(self, stage, task_id, wait):
+		with self.lock:
+			self.waits.setdefault(stage, []).append(wait)
+
+		self.emit({'type': "wait", 'stage': stage, 'task': task_id, 'wait': round(wait, 4), 'time': time.time()})
+
+	def retry(self, stage, task_id, category, attempt):
+		with self.lock:
+			self.retries[stage] = self.retries.get(stage, 0) + 1
+
+		self.emit({
+			'type': "retry", 'stage': stage, 'task': task_id, 'category': category, 'attempt': attempt,
+			'time': time.time()})
+
+	def summary(self, workers):
+		wall = time.monotonic() - self.started
+		stages = {}
+
+		with self.lock:
+			for stage in sorted(set(self.spans) | set(self.waits)):
+				walls = self.spans.get(stage, [])
+				waits = self.waits.get(stage, [])
+				stages[stage] = {
+					'count': len(walls),
+					'p50': round(percentile(walls, 0.5), 3),
+					'p95': round(percentile(walls, 0.95), 3),
+					'max': round(max(walls, default=0.0), 3),
+					'wait_p50': round(percentile(waits, 0.5), 3),
+					'wait_p95': round(percentile(waits, 0.95), 3),
+					'bytes': self.bytes.get(stage, 0),
+					'retries': self.retries.get(stage, 0),
+				}
+
+				# Share of the run the stage's workers spent busy
+				if workers.get(stage) and wall > 0:
+					stages[stage]['utilisation'] = round(sum(walls) / (workers[stage] * wall), 3)
+
+		return {'type': "summary", 'wall': round(wall, 3), 'stages': stages}
+
+	def prometheus(self, workers):
+		summary = self.summary(workers)
+		lines = [f"ytdl_run_seconds {summary['wall']}"]
+
+		for stage, values in summary['stages'].items():
+			for quantile in ("p50", "p95"):
+				lines.append(f'ytdl_stage_seconds{{stage="{stage}",quantile="0.{quantile[1:]}"}} {values[quantile]}')
+				lines.append(
+					f'ytdl_queue_wait_seconds{{stage="{stage}",quantile="0.{quantile[1:]}"}} {values["wait_" + quantile]}')
+
+			lines.append(f'ytdl_stage_seconds_max{{stage="{stage}"}} {values["max"]}')
+			lines.append(f'ytdl_stage_count{{stage="{stage}"}} {values["count"]}')
+			lines.append(f'ytdl_stage_bytes_total{{stage="{stage}"}} {values["bytes"]}')
+			lines.append(f'ytdl_stage_retries_total{{stage="{stage}"}} {values["retries"]}')
+
+			if 'utilisation' in values:
+				lines.append(f'ytdl_worker_utilisation{{stage="{stage}"}} {values["utilisation"]}')
+
+		if self.live:
+			status = self.live()
+			lines.append(f"ytdl_downloads_active {status['active']}")
+			lines.append(f"ytdl_download_bytes_per_second {status['bytes_per_second']}")
+			lines.append(f"ytdl_download_remaining_bytes {status['remaining_bytes']}")
+
+			if status['eta'] is not None:
+				lines.append(f"ytdl_download_eta_seconds {status['eta']}")
+
+		return "\n".join(lines) + "\n"
+
+	def writeTextfile(self, textfile_path, workers):
+		tmp_path = textfile_path + ".tmp"
+
+		with open(tmp_path, "w") as textfile:
+			textfile.write(self.prometheus(workers))
+
+		# node_exporter's textfile collector must never see a half-written file
+		os.replace(tmp_path, textfile_path)
+
+	def serve(self, port, workers):
+		metrics = self
+
+		class MetricsHandler(BaseHTTPRequestHandler):
+
+			def do_GET(self):
+				body = metrics.prometheus(workers).encode()
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+		Thread(target=server.serve_forever, daemon=True).start()
+		return server
+
+	def close(self, workers):
+		summary = self.summary(workers)
+		self.emit(dict(summary, time=time.time()))
+		self.metrics_file.close()
+		return summary
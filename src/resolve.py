@@ -0,0 +1,103 @@
+import json
+import os
+import time
+import uuid
+from threading import local
+from timestamps import parseWindows
+
+# Bulky fields that are never needed to pick a format or download it
+DROPPED_FIELDS = ("automatic_captions", "subtitles", "thumbnails", "heatmap", "chapters", "description")
+
+
+class MetadataCache:
+
+	def __init__(self, cache_dir, ttl):
+		self.cache_dir = cache_dir
+		self.ttl = ttl
+		os.makedirs(cache_dir, exist_ok=True)
+
+	def entryPath(self, video_id):
+		return os.path.join(self.cache_dir, f"{video_id}.json")
+
+	def get(self, video_id):
+		try:
+			with open(self.entryPath(video_id), encoding="utf-8") as entry_file:
+				entry = json.load(entry_file)
+		except (OSError, ValueError):
+			return None
+
+		# Stream URLs expire, so stale entries are resolved again
+		if time.time() - entry['resolved_at'] > self.ttl:
+			return None
+
+		return entry['info']
+
+	def put(self, video_id, info):
+		entry = {
+			'resolved_at': time.time(),
+			'title': info.get('title'),
+			'duration': info.get('duration'),
+			'format_id': info.get('format_id'),
+			'url': info.get('url'),
+			'info': info,
+		}
+		# Unique per writer, workers on other hosts may resolve the same video at the same moment
+		tmp_path = f"{self.entryPath(video_id)}.{uuid.uuid4().hex[:8]}.tmp"
+
+		with open(tmp_path, "w", encoding="utf-8") as entry_file:
+			json.dump(entry, entry_file, ensure_ascii=False)
+
+		os.replace(tmp_path, self.entryPath(video_id))
+
+	def drop(self, video_id):
+		if os.path.exists(self.entryPath(video_id)):
+			os.remove(self.entryPath(video_id))
+
+
+class Resolver:
+
+	def __init__(self, metadata_cache, audio_format="bestaudio/best", limiter=None):
+		self.metadata_cache = metadata_cache
+		self.audio_format = audio_format
+		self.limiter = limiter  # per-host rate limit, only waited on when the cache misses
+		self.local = local()
+
+	def youtubeDL(self):
+		# One YoutubeDL per worker thread, so extractors are initialised once
+		if not hasattr(self.local, "ydl"):
+			import yt_dlp
+
+			self.local.ydl = yt_dlp.YoutubeDL({
+				'format': self.audio_format,
+				'quiet': True,
+				'no_warnings': True,
+				'skip_download': True,
+			})
+
+		return self.local.ydl
+
+	def resolve(self, yt_url, video_id=None):
+		info = self.metadata_cache.get(video_id) if video_id else None
+
+		if info is None:
+			if self.limiter:
+				self.limiter.acquire(yt_url)
+
+			ydl = self.youtubeDL()
+			info = ydl.sanitize_info(ydl.extract_info(yt_url, download=False))
+
+			for field in DROPPED_FIELDS:
+				info.pop(field, None)
+
+			self.metadata_cache.put(video_id or info['id'], info)
+
+		return info
+
+
+def checkWindow(info, timestamps):
+	duration = info.get('duration')
+
+	# The window grammar itself is checked at ingest, only the video duration is known here
+	for start_sec, _ in parseWindows(timestamps):
+		if duration and start_sec >= duration:
+			raise ValueError(f"Timestamp window at {start_sec}s in {timestamps} starts after the video ends ({duration}s)")
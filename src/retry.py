@@ -0,0 +1,74 @@
+import asyncio
+import random
+import re
+
+TRANSIENT, PERMANENT, LOCAL = "transient", "permanent", "local"
+
+TRANSIENT_PATTERNS = [
+	r'timed? ?out', r'http error 5\d\d', r'http error 429', r'too many requests', r'rate.?limit',
+	r'connection (reset|refused|aborted)', r'temporary failure', r'incompleteread', r'remote end closed',
+	r'unable to download (webpage|api page)', r'http error 403',  # expired stream URLs answer 403
+	# yt-dlp's section downloads run through ffmpeg, so network errors surface as its exit code
+	r'ffmpeg exited with code',
+]
+PERMANENT_PATTERNS = [
+	r'private video', r'video unavailable', r'has been removed', r'terminated', r'not available in your country',
+	r'geo.?restrict', r'blocked', r'copyright', r'sign in to confirm your age', r'members.only',
+	r'http error 404', r'unsupported url', r'is not a valid url',
+]
+# Only our own trim and probe calls, not ffmpeg that yt-dlp runs for a download
+LOCAL_PATTERNS = [
+	r'^ffmpeg failed:', r'^ffprobe failed:', r'ffmpeg (is )?not (installed|found)', r'no space left', r'permission denied',
+	r'read-only file system',
+]
+
+
+class TaskFailure(Exception):
+
+	def __init__(self, cause, category, attempts):
+		super().__init__(str(cause))
+		self.cause = cause
+		self.category = category
+		self.attempts = attempts
+
+
+def classifyError(error):
+	message = str(error).lower()
+
+	for category, patterns in ((TRANSIENT, TRANSIENT_PATTERNS), (PERMANENT, PERMANENT_PATTERNS), (LOCAL, LOCAL_PATTERNS)):
+		if any(re.search(pattern, message) for pattern in patterns):
+			return category
+
+	if isinstance(error, TimeoutError | ConnectionError):
+		return TRANSIENT
+
+	if isinstance(error, OSError):
+		return LOCAL
+
+	# Unknown failures are not retried blindly
+	return PERMANENT
+
+
+def backoffDelay(attempt, base, cap):
+	# Full jitter keeps parallel workers from retrying in lockstep
+	return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+async def retryAsync(call, max_attempts=4, base=2.0, cap=60.0, on_attempt_failed=None):
+	attempt = 0
+
+	while True:
+		attempt += 1
+
+		try:
+			return await call()
+		except Exception as error:
+			category = classifyError(error)
+
+			if on_attempt_failed:
+				on_attempt_failed(error, category, attempt)
+
+			if category != TRANSIENT or attempt >= max_attempts:
+				raise TaskFailure(error, category, attempt) from error
+
+			await asyncio.sleep(backoffDelay(attempt, base, cap))
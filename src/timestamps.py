@@ -0,0 +1,91 @@
+import re
+
+# [h:]mm:ss with optional fractional seconds: 1:05, 01:02:03, 1:05.250
+CLOCK_PATTERN = re.compile(r'(?:(\d+):)?(\d+):(\d+(?:\.\d+)?)$')
+# Plain seconds: 45, 45.5, 45s
+SECONDS_PATTERN = re.compile(r'(\d+(?:\.\d+)?)s?$')
+# Durations after a "+": 30s, 1m30s, 2m, 1h5m
+DURATION_PATTERN = re.compile(r'(?:(\d+(?:\.\d+)?)h)?(?:(\d+(?:\.\d+)?)m)?(?:(\d+(?:\.\d+)?)s)?$')
+# Hyphen or the en dash spreadsheets like to substitute for it
+DASH_PATTERN = re.compile(r'\s*[-–]\s*')
+
+
+class TimestampError(ValueError):
+	pass
+
+
+def seconds(value):
+	# Whole seconds stay ints so cache keys and ffmpeg arguments look the same as before
+	return int(value) if float(value).is_integer() else round(float(value), 3)
+
+
+def parseTimestamp(text):
+	text = text.strip()
+	match = CLOCK_PATTERN.match(text)
+
+	if match:
+		hours, minutes, secs = match.groups()
+
+		if float(secs) >= 60 or (hours is not None and int(minutes) >= 60):
+			raise TimestampError(f"Out of range timestamp {text!r}")
+
+		return seconds(int(hours or 0) * 3600 + int(minutes) * 60 + float(secs))
+
+	match = SECONDS_PATTERN.match(text)
+
+	if match:
+		return seconds(match.group(1))
+
+	raise TimestampError(f"Bad timestamp {text!r}, expected m:ss, h:mm:ss or seconds")
+
+
+def parseDuration(text):
+	match = DURATION_PATTERN.match(text.strip())
+
+	if match and any(match.groups()):
+		hours, minutes, secs = (float(group or 0) for group in match.groups())
+		return seconds(hours * 3600 + minutes * 60 + secs)
+
+	return parseTimestamp(text)
+
+
+def parseWindow(text):
+	text = text.strip()
+
+	if "+" in text:
+		start, duration = text.split("+", 1)
+		start_sec = parseTimestamp(start)
+		length = parseDuration(duration)
+
+		if length <= 0:
+			raise TimestampError(f"Empty window {text!r}")
+
+		return start_sec, seconds(start_sec + length)
+
+	bounds = DASH_PATTERN.split(text, maxsplit=1)
+
+	if len(bounds) != 2:
+		raise TimestampError(f"Bad window {text!r}, expected start-end, start- or start+duration")
+
+	start_sec = parseTimestamp(bounds[0])
+
+	# An open end runs to the end of the video
+	if not bounds[1]:
+		return start_sec, None
+
+	end_sec = parseTimestamp(bounds[1])
+
+	if end_sec <= start_sec:
+		raise TimestampError(f"Window {text!r} ends before it starts")
+
+	return start_sec, end_sec
+
+
+def parseWindows(timestamps):
+	# Several clips per row are separated by semicolons: "0:30-1:00; 2:10-2:40"
+	windows = [parseWindow(window) for window in str(timestamps).split(";") if window.strip()]
+
+	if not windows:
+		raise TimestampError(f"No timestamp window in {timestamps!r}")
+
+	return windows
@@ -0,0 +1,191 @@
+import json
+import multiprocessing
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+TRIM_MODES = ("copy", "accurate")
+
+# codec is the ffmpeg encoder, source_codec what ffprobe reports for a stream it can copy
+OUTPUT_PROFILES = {
+	"mp3": {'ext': "mp3", 'codec': "libmp3lame", 'source_codec': "mp3", 'args': ["-b:a", "192k"]},
+	"aac": {'ext': "m4a", 'codec': "aac", 'source_codec': "aac", 'args': ["-b:a", "192k"]},
+	"opus": {'ext': "opus", 'codec': "libopus", 'source_codec': "opus", 'args': ["-b:a", "128k"]},
+	"flac": {'ext': "flac", 'codec': "flac", 'source_codec': "flac", 'args': []},
+	"original": {'ext': None, 'codec': "copy", 'source_codec': None, 'args': []},
+}
+
+# Containers used when the source stream is remuxed as is
+CODEC_EXTENSIONS = {"opus": "opus", "aac": "m4a", "mp3": "mp3", "vorbis": "ogg", "flac": "flac"}
+
+
+@dataclass(slots=True)
+class TrimJob:
+	task: object
+	source_path: str
+	output_paths: list  # one clip per window
+	windows: list  # (start_sec, end_sec) pairs in the time of source_path, None ends run to its end
+	profile: str = "mp3"
+	source_codec: str = None
+	source_start: float = 0.0  # source time of the first sample in source_path, the windows are relative to it
+	title: str = None
+	fingerprint_key: str = None  # cache key the source is indexed under, None when it is not fingerprinted
+
+
+def runFfmpeg(args):
+	command = ["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-nostdin", "-y"] + args
+	result = subprocess.run(command, capture_output=True, text=True)
+
+	if result.returncode != 0:
+		raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()}")
+
+
+def buildFilters(normalize=False, target=-16, trim_silence=False, fade=0):
+	filters = []
+	edge_filters = []
+
+	if trim_silence:
+		edge_filters.append("silenceremove=start_periods=1:start_threshold=-50dB:start_silence=0.1")
+
+	if fade:
+		edge_filters.append(f"afade=t=in:d={fade}")
+
+	if edge_filters:
+		# The tail is handled by reversing, so no duration is needed up front
+		filters += edge_filters + ["areverse"] + edge_filters + ["areverse"]
+
+	if normalize:
+		# Single-pass dynamic mode on every run, so reruns give the same output as the first run.
+		# loudnorm works at 192 kHz internally.
+		filters += [f"loudnorm=I={target}:TP=-1.5:LRA=11", "aresample=48000"]
+
+	return ",".join(filters) or None
+
+
+def probeMedia(file_path):
+	# Container and stream headers only, so truncated or broken files are caught without a decode
+	command = [
+		"ffprobe", "-v", "error", "-select_streams", "a:0",
+		"-show_entries", "format=duration,start_time:stream=codec_name", "-of", "json", file_path]
+	result = subprocess.run(command, capture_output=True, text=True)
+
+	if result.returncode != 0:
+		raise RuntimeError(f"ffprobe failed: {result.stderr.strip()}")
+
+	probed = json.loads(result.stdout)
+
+	if not probed.get('streams'):
+		raise RuntimeError(f"ffprobe failed: no audio stream in {file_path}")
+
+	duration = probed.get('format', {}).get('duration')
+	start = probed.get('format', {}).get('start_time')
+	return {
+		'codec': probed['streams'][0]['codec_name'], 'duration': float(duration) if duration else None,
+		'start': float(start) if start else 0.0}
+
+
+def partialPath(output_path):
+	# Keeps the extension, ffmpeg picks the container from it
+	root, ext = os.path.splitext(output_path)
+	return f"{root}.part{ext}"
+
+
+def outputExtension(profile, source_codec):
+	if profile not in OUTPUT_PROFILES:
+		raise ValueError(f"Unknown output profile: {profile}")
+
+	return OUTPUT_PROFILES[profile]['ext'] or CODEC_EXTENSIONS.get(source_codec, "mka")
+
+
+def trimAudio(file_path, outputs, mode="copy", profile="mp3", source_codec=None, filters=None):
+	# outputs holds (output_path, start_sec, end_sec) per clip, all cut in one ffmpeg call
+	if mode not in TRIM_MODES:
+		raise ValueError(f"Unknown trim mode: {mode}")
+
+	# ffmpeg writes next to the final names, which only appear once the whole call has succeeded
+	final_paths = [output_path for output_path, _, _ in outputs]
+	outputs = [(partialPath(output_path), start_sec, end_sec) for output_path, start_sec, end_sec in outputs]
+
+	output_profile = OUTPUT_PROFILES[profile]
+
+	if filters and profile == "original":
+		# Filtered audio has to be encoded, so stay in the source codec
+		matching = [name for name, candidate in OUTPUT_PROFILES.items() if candidate['source_codec'] == source_codec]
+
+		if not matching:
+			raise ValueError(f"Cannot post-process {source_codec} audio with the original profile")
+
+		output_profile = OUTPUT_PROFILES[matching[0]]
+
+	if not filters and (profile == "original" or (mode == "copy" and source_codec == output_profile['source_codec'])):
+		# Cuts land on codec frame boundaries (~20-26 ms) and skip a second lossy encode
+		codec_args = ["-c:a", "copy"]
+	else:
+		codec_args = ["-c:a", output_profile['codec']] + output_profile['args']
+
+	starts = [start_sec for _, start_sec, _ in outputs]
+	ends = [end_sec for _, _, end_sec in outputs]
+	first = min(starts) if None not in starts else None
+	last = max(ends) if None not in ends else None
+	args = []
+
+	# Input seeking only reads the frames inside the union of the windows
+	if first is not None:
+		args += ["-ss", str(first)]
+
+	if last is not None:
+		args += ["-t", str(last - (first or 0))]
+
+	args += ["-i", file_path]
+
+	if len(outputs) == 1:
+		# Post-processing runs in the same decode as the cut
+		args += ["-map", "0:a"] + (["-af", filters] if filters else []) + codec_args + [outputs[0][0]]
+	elif codec_args[1] == "copy":
+		# Copied streams cannot go through a filter graph, so each output skips to its own window
+		for output_path, start_sec, end_sec in outputs:
+			args += ["-map", "0:a", "-ss", str(start_sec - first)]
+			args += (["-t", str(end_sec - start_sec)] if end_sec is not None else []) + codec_args + [output_path]
+	else:
+		# One decode is split into a trimmed branch per clip
+		labels = "".join(f"[split{i}]" for i in range(len(outputs)))
+		graph = [f"[0:a]asplit={len(outputs)}{labels}"]
+
+		for i, (_, start_sec, end_sec) in enumerate(outputs):
+			chain = f"atrim=start={start_sec - first}" + (f":end={end_sec - first}" if end_sec is not None else "")
+			chain += ",asetpts=PTS-STARTPTS"
+			graph.append(f"[split{i}]{chain}{',' + filters if filters else ''}[clip{i}]")
+
+		args += ["-filter_complex", ";".join(graph)]
+
+		for i, (output_path, _, _) in enumerate(outputs):
+			args += ["-map", f"[clip{i}]"] + codec_args + [output_path]
+
+	try:
+		runFfmpeg(args)
+	except Exception:
+		for partial_path, _, _ in outputs:
+			if os.path.exists(partial_path):
+				os.remove(partial_path)
+		raise
+
+	for (partial_path, _, _), final_path in zip(outputs, final_paths):
+		os.replace(partial_path, final_path)
+
+
+class TrimService:
+
+	def __init__(self, workers=None):
+		# Long-lived worker processes, reused across jobs, each one drives a single ffmpeg at a time.
+		# Spawned rather than forked, since the parent is full of downloader threads.
+		self.workers = workers or os.cpu_count() or 4
+		self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+	def submit(self, job, mode="copy", filters=None):
+		# Only the trim arguments cross the process boundary, not the task and its metadata
+		outputs = [(output_path, *window) for output_path, window in zip(job.output_paths, job.windows)]
+		return self.pool.submit(trimAudio, job.source_path, outputs, mode, job.profile, job.source_codec, filters)
+
+	def close(self):
+		self.pool.shutdown()